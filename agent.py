@@ -1,4 +1,5 @@
 import numpy as np
+from parameter_specs import resolve_parameters
 
 
 class Counter:
@@ -20,6 +21,9 @@ class Counter:
 
 class Agent:
     def __init__(self, parameters):
+        # Spec strings such as 'normal(80, 10) as int' become Distribution and Profile objects, which are callable
+        parameters = resolve_parameters(parameters)
+
         # Parameters
         self.type = parameters['type']
         self.size = parameters['size'] if not callable(parameters['size']) else parameters['size']()
@@ -0,0 +1,58 @@
+class AgentView:
+    # One agent of a VectorizedSystem, with the attribute names of Agent. Reading an attribute reads it from the agent
+    # arrays (position and velocity as views of the arrays), assigning one writes it into them, so code written for
+    # lists of Agent objects can inspect and change the agents of a VectorizedSystem in place.
+    arrays = {'position': 'position', 'velocity': 'velocity', 'state': 'state', 'mass': 'mass', 'size': 'size',
+              'immobile': 'immobile', 'transparent': 'transparent', 'willRecover': 'will_recover',
+              'healthy_velocity': 'healthy_velocity', 'incubation_velocity': 'incubation_velocity',
+              'sickness_velocity': 'sickness_velocity', 'timeToIncubate': 'time_to_incubate',
+              'timeToRecover': 'time_to_recover', 'timeToDie': 'time_to_die', 'countdown': 'countdown'}
+
+    # Attributes that are looked up in a table of the system by an id
+    tables = {'type': ('agent_types', 'type_id'), 'disease_profile': ('disease_profiles', 'disease_profile_id'),
+              'infection_profile': ('infection_profiles', 'infection_profile_id')}
+
+    __slots__ = ('system', 'id')
+
+    def __init__(self, system, index):
+        object.__setattr__(self, 'system', system)
+        object.__setattr__(self, 'id', index)
+
+    def __getattr__(self, name):
+        if name in self.arrays:
+            if name in ('position', 'velocity'):
+                return getattr(self.system, name)[self.id]
+            return self.system.agent_values(self.arrays[name], self.id).item()
+        if name in self.tables:
+            table, ids = self.tables[name]
+            return getattr(self.system, table)[self.system.agent_values(ids, self.id)]
+
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name not in self.arrays:
+            raise AttributeError(name + ' can not be set on an agent of a VectorizedSystem')
+
+        self.system.set_agent_values(self.arrays[name], self.id, value)
+
+    def __repr__(self):
+        return 'AgentView(' + str(self.id) + ', type=' + str(self.type) + ', state=' + str(self.state) + ')'
+
+
+class AgentViews:
+    # The agents of a VectorizedSystem as a sequence of AgentView, made on access
+    def __init__(self, system):
+        self.system = system
+
+    def __len__(self):
+        return self.system.number_of_agents
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [AgentView(self.system, i) for i in range(*index.indices(len(self)))]
+
+        return AgentView(self.system, range(len(self))[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield AgentView(self.system, index)
@@ -0,0 +1,231 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from corona_simulation import healthy_old_young
+from system import System
+from vectorized_system import VectorizedSystem
+from parallel_system import ParallelSystem
+
+# Engines and the population sizes they are benchmarked at by default. The original engine compares every pair of
+# agents in Python, so it is only run at the smaller sizes, and the parallel engine only pays off for large ones.
+ENGINES = {'original': System, 'vectorized': VectorizedSystem, 'parallel': ParallelSystem}
+SIZES = {'original': (100, 1000), 'vectorized': (100, 1000, 10000, 100000), 'parallel': (10000, 100000, 1000000)}
+
+# Modules whose import time is measured, and the heavy plotting and video modules they should not load unless rendering
+IMPORTED_MODULES = ('system', 'vectorized_system', 'ensemble', 'rendering')
+HEAVY_MODULES = ('matplotlib', 'cv2')
+
+# Share of every group of the healthy/old/young scenario in the population
+SHARES = {'Healthy': 0.56, 'Sick': 0.04, 'Old': 0.20, 'Young': 0.20}
+
+
+def benchmark_scenario(number_of_agents, seed, export_path):
+    # The healthy/old/young scenario with number_of_agents agents, in a box scaled to keep the density of the original
+    # 100 agents, seeded so that every run of the benchmark simulates the same thing
+    population = {name: int(round(share*number_of_agents)) for name, share in SHARES.items()}
+    population['Healthy'] += number_of_agents - sum(population.values())
+
+    system_params, populations = healthy_old_young(population=population)
+    system_params.update(box=system_params['box']*np.sqrt(number_of_agents / 100), seed=seed, print_interval=0,
+                         render_stride=0, measurements_file=None, export_path=export_path)
+    for name, agent_parameters, count in populations:
+        agent_parameters['box'] = system_params['box']
+
+    return system_params, populations
+
+
+def build(system_class, system_params, populations, seed):
+    np.random.seed(seed)
+    random.seed(seed)
+
+    system = system_class(system_params)
+    for name, agent_parameters, count in populations:
+        system.add_agents(agent_parameters, count)
+
+    return system
+
+
+def close(system):
+    # Stop the worker processes of the parallel engine
+    if isinstance(system, ParallelSystem):
+        system.close()
+
+
+def timed(function, calls, budget):
+    # Call function up to calls times, but stop once budget seconds have passed (after at least one call)
+    durations = []
+    while len(durations) < calls and sum(durations) < budget:
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+
+    return {'calls': len(durations), 'seconds': sum(durations), 'seconds_per_call': sum(durations) / len(durations),
+            'min_seconds_per_call': min(durations)}
+
+
+def benchmark_case(engine, number_of_agents, steps=20, frames=5, budget=30, seed=0, interaction_cutoff=10, precision='float64', setups=3):
+    # Time the setup, steps, measurements, plots and video export of one engine at one population size, and the peak
+    # memory of setup, a step and a measurement. Every phase stops after budget seconds. The setup is timed setups
+    # times, and its fastest time is reported like the other phases. Plotting and video export are timed after a
+    # warm-up, so the first lazy import of matplotlib and cv2 does not count for whichever engine happens to run
+    # first.
+    system_class = ENGINES[engine]
+    with tempfile.TemporaryDirectory() as directory:
+        system_params, populations = benchmark_scenario(number_of_agents, seed, directory + '/')
+        if issubclass(system_class, VectorizedSystem):
+            system_params.update(interaction_cutoff=interaction_cutoff, precision=precision)
+
+        durations = []
+        while len(durations) < setups and sum(durations) < budget:
+            system = None
+            gc.collect()
+            start = time.perf_counter()
+            system = build(system_class, system_params, populations, seed)
+            durations.append(time.perf_counter() - start)
+        result = {'engine': engine, 'agents': number_of_agents,
+                  'setup': {'calls': len(durations), 'seconds': min(durations), 'seconds_per_call': sum(durations) / len(durations),
+                            'min_seconds_per_call': min(durations)}}
+        if isinstance(system, VectorizedSystem):
+            result['bytes_per_agent'] = system.bytes_per_agent()
+
+        def step():
+            system.step()
+            system.time += 1
+
+        result['step'] = timed(step, steps, budget)
+        result['step']['agent_steps_per_second'] = number_of_agents / result['step']['seconds_per_call']
+        result['measure'] = timed(system.measure, steps, budget)
+
+        def plot():
+            # Every frame gets its own file, for the video
+            system.save_plot(system.frame_path(system.time))
+            system.time += 1
+
+        # Warm-up plot outside the folder of the video frames, and the video module
+        warm_up = os.path.join(directory, 'warm_up')
+        os.mkdir(warm_up)
+        system.save_plot(os.path.join(warm_up, 'frame.png'))
+        import cv2
+
+        result['save_plot'] = timed(plot, frames, budget)
+        result['video'] = timed(system.create_animation_from_folder, 1, budget)
+        result['video']['frames'] = result['save_plot']['calls']
+        close(system)
+        del system
+
+    gc.collect()
+    tracemalloc.start()
+    system = build(system_class, system_params, populations, seed)
+    system.step()
+    system.measure()
+    result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    close(system)
+
+    return result
+
+
+def import_time(module, repeats=3):
+    # Seconds to import module in a fresh interpreter (the fastest of repeats), and the heavy modules it loaded
+    code = ('import sys, time\n'
+            'start = time.perf_counter()\n'
+            'import ' + module + '\n'
+            'print(time.perf_counter() - start)\n'
+            'print(" ".join(sorted({name.split(".")[0] for name in sys.modules} & set(' + repr(HEAVY_MODULES) + '))))\n')
+    seconds = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split('\n')
+        seconds.append(float(output[0]))
+
+    return {'seconds': min(seconds), 'heavy_modules': output[1].split()}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(engines=tuple(ENGINES), sizes=None, **options):
+    imports = {}
+    for module in IMPORTED_MODULES:
+        imports[module] = import_time(module)
+        print('import', module, '{:.3f} s'.format(imports[module]['seconds']), 'loads ' + ', '.join(imports[module]['heavy_modules']) if imports[module]['heavy_modules'] else '')
+
+    results = []
+    for engine in engines:
+        for number_of_agents in sizes or SIZES[engine]:
+            result = benchmark_case(engine, number_of_agents, **options)
+            print(engine, number_of_agents, 'agents: setup {:.3f} s, step {:.4f} s ({:.3g} agent-steps/s), peak memory {:.1f} MB'.format(
+                result['setup']['seconds'], result['step']['seconds_per_call'], result['step']['agent_steps_per_second'], result['peak_memory_bytes'] / 1e6)
+                + (', {:.0f} bytes per agent'.format(result['bytes_per_agent']) if 'bytes_per_agent' in result else ''))
+            results.append(result)
+
+    return {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'options': options, 'imports': imports, 'results': results}
+
+
+def compare(old, new, tolerance=0.2):
+    # Imports and phases of every case that got more than tolerance slower (or used more memory) from old to new results
+    regressions = []
+    for module, result in new.get('imports', {}).items():
+        previous = old.get('imports', {}).get(module)
+        if previous is not None and result['seconds'] > previous['seconds']*(1 + tolerance):
+            regressions.append(('import', module, 'seconds', previous['seconds'], result['seconds']))
+
+    old_cases = {(result['engine'], result['agents']): result for result in old['results']}
+    for result in new['results']:
+        previous = old_cases.get((result['engine'], result['agents']))
+        if previous is None:
+            continue
+
+        for phase in ('setup', 'step', 'measure', 'save_plot', 'video', 'peak_memory_bytes', 'bytes_per_agent'):
+            if phase not in previous or phase not in result:
+                continue
+            key = 'seconds' if phase == 'setup' else 'min_seconds_per_call'
+            before = previous[phase] if phase in ('peak_memory_bytes', 'bytes_per_agent') else previous[phase][key]
+            after = result[phase] if phase in ('peak_memory_bytes', 'bytes_per_agent') else result[phase][key]
+            if after > before*(1 + tolerance):
+                regressions.append((result['engine'], result['agents'], phase, before, after))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the simulation engines at several population sizes')
+    parser.add_argument('output', nargs='?', default='benchmark.json', help='file the results are written to')
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument('--sizes', nargs='+', type=int, help='population sizes (default: depends on the engine)')
+    parser.add_argument('--steps', type=int, default=20, help='number of steps and measurements to time')
+    parser.add_argument('--frames', type=int, default=5, help='number of frames to plot and export as video')
+    parser.add_argument('--budget', type=float, default=30, help='seconds after which a phase is cut short')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--precision', default='float64', choices=['float64', 'float32'], help='precision of the vectorized engines')
+    parser.add_argument('--compare', help='earlier results to compare with, slowdowns over --tolerance are reported')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    arguments = parser.parse_args()
+
+    benchmarks = run_benchmarks(arguments.engines, arguments.sizes, steps=arguments.steps, frames=arguments.frames,
+                                budget=arguments.budget, seed=arguments.seed, precision=arguments.precision)
+    with open(arguments.output, 'w', encoding='utf-8') as file:
+        json.dump(benchmarks, file, indent=4)
+
+    if arguments.compare is not None:
+        with open(arguments.compare, encoding='utf-8') as file:
+            regressions = compare(json.load(file), benchmarks, arguments.tolerance)
+        for engine, case, phase, before, after in regressions:
+            print('Regression:', engine, case, phase, before, '->', after)
+        if len(regressions) > 0:
+            raise SystemExit(1)
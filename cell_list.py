@@ -0,0 +1,105 @@
+import numpy as np
+
+
+def minimum_image(difference, box):
+    # Periodic minimum image of an (..., 2) array of difference vectors, matching vector_difference
+    return difference - box * np.round(difference / box)
+
+
+class CellList:
+    # Bins agents into a grid of square cells over the periodic box, so that all pairs closer than a cutoff can be
+    # found by only comparing agents in neighbouring cells. The cells are at least cutoff + skin wide. Candidate pairs
+    # within cutoff + skin are kept between steps, and the grid is only rebuilt once some agent has moved more than
+    # skin / 2 since the last build, so most steps only recompute the distances of the candidate pairs.
+    #
+    # With replicas > 1, the positions are those of that many independent systems of equal size, one after the other,
+    # and pairs are only formed within each system. Every system gets its own grid of cells.
+    def __init__(self, box, cutoff, skin=0, replicas=1):
+        self.box = np.asarray(box, dtype=float)
+        self.cutoff = cutoff
+        self.skin = skin
+        self.replicas = replicas
+
+        self.cells = np.maximum(np.floor(self.box / (cutoff + skin)).astype(int), 1)
+        self.cell_size = self.box / self.cells
+
+        # Neighbour cell offsets, duplicates removed for boxes that are only one or two cells wide
+        offsets = np.array([[dx, dy] for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+        self.offsets = np.unique(offsets % self.cells, axis=0)
+
+        # State of the last build
+        self.reference_position = None
+        self.candidates_i = np.zeros(0, dtype=int)
+        self.candidates_j = np.zeros(0, dtype=int)
+        self.builds = 0
+
+    def cell_index(self, position):
+        cell = np.floor((position % self.box) / self.cell_size).astype(int) % self.cells
+        return self.replica_offset(len(position)) + cell[:, 0]*self.cells[1] + cell[:, 1], cell
+
+    def replica_offset(self, number_of_agents):
+        # First cell id of the system of every agent
+        if self.replicas == 1:
+            return 0
+        return np.repeat(np.arange(self.replicas)*(self.cells[0]*self.cells[1]), number_of_agents // self.replicas)
+
+    def build(self, position):
+        # Sort agents by cell, then collect every agent pair in the same or adjacent cells
+        cell_id, cell = self.cell_index(position)
+        order = np.argsort(cell_id, kind='stable')
+        counts = np.bincount(cell_id, minlength=self.replicas*self.cells[0]*self.cells[1])
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+        agents = np.arange(len(position))
+        first_cell = self.replica_offset(len(position))
+        candidates_i = []
+        candidates_j = []
+        for offset in self.offsets:
+            neighbour = (cell + offset) % self.cells
+            neighbour_id = first_cell + neighbour[:, 0]*self.cells[1] + neighbour[:, 1]
+
+            number = counts[neighbour_id]
+            i = np.repeat(agents, number)
+            within = np.arange(number.sum()) - np.repeat(np.cumsum(number) - number, number)
+            j = order[np.repeat(starts[neighbour_id], number) + within]
+
+            unique = i < j
+            candidates_i.append(i[unique])
+            candidates_j.append(j[unique])
+
+        i = np.concatenate(candidates_i)
+        j = np.concatenate(candidates_j)
+        r = np.linalg.norm(minimum_image(position[i] - position[j], self.box), axis=1)
+        close = r < self.cutoff + self.skin
+
+        self.candidates_i = i[close]
+        self.candidates_j = j[close]
+        self.reference_position = position.copy()
+        self.builds += 1
+
+    def needs_rebuild(self, position):
+        if self.reference_position is None or len(self.reference_position) != len(position):
+            return True
+
+        moved = np.linalg.norm(minimum_image(position - self.reference_position, self.box), axis=1)
+        return moved.max(initial=0) > self.skin / 2
+
+    def update(self, position):
+        if self.needs_rebuild(position):
+            self.build(position)
+
+    def pairs(self, position):
+        # All ordered pairs (i, j), i != j, closer than the cutoff, with the minimum image displacement from j to i
+        # and its length. Both (i, j) and (j, i) are returned.
+        self.update(position)
+
+        displacement = minimum_image(position[self.candidates_i] - position[self.candidates_j], self.box)
+        r = np.linalg.norm(displacement, axis=1)
+        close = r < self.cutoff
+
+        i = self.candidates_i[close]
+        j = self.candidates_j[close]
+        displacement = displacement[close]
+        r = r[close]
+
+        return np.concatenate((i, j)), np.concatenate((j, i)), np.concatenate((displacement, -displacement)), np.concatenate((r, r))
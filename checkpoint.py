@@ -0,0 +1,93 @@
+import json
+import os
+import random
+import numpy as np
+from parameter_specs import Profile, parse_spec
+
+# Checkpoint file layout: MAGIC, the header length as uint64, a JSON header, then the raw arrays, each starting at a
+# multiple of ALIGNMENT bytes. The header holds the scalar state and, for every array, its dtype, shape and offset, so
+# the arrays can be memory-mapped straight from the file.
+MAGIC = b'MDVSCKPT'
+ALIGNMENT = 64
+
+
+def write_checkpoint(path, header, arrays):
+    # Write header and arrays to a temporary file next to path, then replace path with it in one step, so a run
+    # killed while writing leaves the previous checkpoint intact
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT)*ALIGNMENT
+
+    header_bytes = json.dumps(dict(header, arrays=layout)).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT)*ALIGNMENT
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(MAGIC + np.uint64(len(header_bytes)).tobytes() + header_bytes)
+        for name, array in arrays.items():
+            file.seek(data_start + layout[name]['offset'])
+            file.write(np.ascontiguousarray(array).tobytes())
+        file.truncate(data_start + offset)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temporary_path, path)
+
+
+def read_checkpoint(path, mmap=True):
+    # Header and arrays of a checkpoint. With mmap the arrays are copy-on-write memory maps of the file: loading is
+    # immediate, and changing them does not change the file.
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a checkpoint file')
+        header_length = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+        header = json.loads(file.read(header_length).decode('utf-8'))
+    data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT)*ALIGNMENT
+
+    arrays = {}
+    for name, layout in header.pop('arrays').items():
+        dtype, shape = np.dtype(layout['dtype']), tuple(layout['shape'])
+        if mmap and np.prod(shape) > 0:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='c', offset=data_start + layout['offset'], shape=shape)
+        else:
+            with open(path, 'rb') as file:
+                file.seek(data_start + layout['offset'])
+                arrays[name] = np.fromfile(file, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+    return header, arrays
+
+
+def random_states(generator):
+    # States of the system generator and of the global numpy and random generators, as JSON
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+
+    return {'system': generator.bit_generator.state,
+            'numpy': [name, keys.tolist(), position, has_gauss, cached_gaussian],
+            'random': [random.getstate()[0], list(random.getstate()[1]), random.getstate()[2]]}
+
+
+def restore_random_states(generator, states):
+    generator.bit_generator.state = states['system']
+
+    name, keys, position, has_gauss, cached_gaussian = states['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), position, has_gauss, cached_gaussian))
+
+    version, internal_state, gauss_next = states['random']
+    random.setstate((version, tuple(internal_state), gauss_next))
+
+
+def serialize_profile(profile):
+    # Profiles are stored as spec strings or numbers, Python callables can not be stored
+    if isinstance(profile, (int, float)):
+        return profile
+    if isinstance(profile, Profile):
+        return str(profile)
+
+    raise ValueError('Can not checkpoint the profile ' + repr(profile) + ', use a spec string such as \'step(r0=4, p=0.75)\' instead')
+
+
+def deserialize_profile(profile):
+    return parse_spec(profile, True) if isinstance(profile, str) else profile
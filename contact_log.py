@@ -0,0 +1,169 @@
+import json
+import numpy as np
+from disease import INCUBATING, SICK
+
+# Contact log file layout: MAGIC, the header length as uint32, a JSON header with the agent types, the type of every
+# agent (by agent id) and the agents that were infectious when the log started, followed by chunks of events. A chunk
+# is the number of events n as uint32, followed by the n values of every column in COLUMNS, one column after the other.
+MAGIC = b'MDVSCONT'
+COLUMNS = (('time', np.dtype('<i4')), ('source', np.dtype('<i4')), ('target', np.dtype('<i4')),
+           ('distance', np.dtype('<f4')), ('infected', np.dtype('i1')))
+EVENT_SIZE = sum(dtype.itemsize for name, dtype in COLUMNS)
+
+
+class ContactLogWriter:
+    # Records every exposure of a susceptible agent to an infectious one: the time, the ids of the infectious source
+    # and the exposed target, their distance, and whether the exposure infected the target. Events are collected in
+    # preallocated columns of chunk_size events, which are appended to the file as one chunk whenever they are full,
+    # so the memory used does not grow with the number of events. With resume_size, an existing log is continued after
+    # its first resume_size bytes (when resuming a checkpoint).
+    def __init__(self, path, agent_types, type_ids, infectious_ids, chunk_size=65536, resume_size=None):
+        self.path = path
+        self.columns = {name: np.zeros(chunk_size, dtype=dtype) for name, dtype in COLUMNS}
+        self.events = 0
+        self.events_written = 0
+
+        if resume_size is not None:
+            self.file = open(path, 'r+b')
+            self.file.truncate(resume_size)
+            self.file.seek(0, 2)
+            return
+
+        header = json.dumps({'agent_types': list(agent_types),
+                             'type_ids': np.asarray(type_ids).tolist(),
+                             'infectious_ids': np.asarray(infectious_ids).tolist()}).encode('utf-8')
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC + np.uint32(len(header)).tobytes() + header)
+        self.file.flush()
+
+    def append(self, time, source, target, distance, infected):
+        # One event, or a batch of events given as arrays
+        source, target, distance, infected = np.atleast_1d(source, target, distance, infected)
+        chunk_size = len(self.columns['time'])
+
+        start = 0
+        while start < len(source):
+            count = min(len(source) - start, chunk_size - self.events)
+            end = self.events + count
+            self.columns['time'][self.events:end] = time
+            self.columns['source'][self.events:end] = source[start:start + count]
+            self.columns['target'][self.events:end] = target[start:start + count]
+            self.columns['distance'][self.events:end] = distance[start:start + count]
+            self.columns['infected'][self.events:end] = infected[start:start + count]
+            self.events = end
+            start += count
+
+            if self.events == chunk_size:
+                self.flush()
+
+    def flush(self):
+        if self.events == 0:
+            return
+
+        self.file.write(np.uint32(self.events).tobytes() + b''.join(self.columns[name][:self.events].tobytes() for name, dtype in COLUMNS))
+        self.file.flush()
+        self.events_written += self.events
+        self.events = 0
+
+    def size(self):
+        # Size of the file after flushing, to resume from
+        self.flush()
+        return self.file.tell()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_contacts(path):
+    # Header and events of a contact log, as a dictionary of columns. A partially written last chunk (of a run still
+    # going) is ignored.
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a contact log file')
+        header_length = int(np.frombuffer(file.read(4), dtype=np.uint32)[0])
+        header = json.loads(file.read(header_length).decode('utf-8'))
+        data = file.read()
+
+    chunks = {name: [] for name, dtype in COLUMNS}
+    offset = 0
+    while offset + 4 <= len(data):
+        events = int(np.frombuffer(data, dtype=np.uint32, count=1, offset=offset)[0])
+        if offset + 4 + events*EVENT_SIZE > len(data):
+            break
+
+        offset += 4
+        for name, dtype in COLUMNS:
+            chunks[name].append(np.frombuffer(data, dtype=dtype, count=events, offset=offset))
+            offset += events*dtype.itemsize
+
+    contacts = {name: np.concatenate(chunks[name]) if len(chunks[name]) > 0 else np.zeros(0, dtype=dtype) for name, dtype in COLUMNS}
+    return header, contacts
+
+
+def transmission_tree(contacts):
+    # Who infected whom: the infected agents, the agent that infected them, the time of infection, and the generation,
+    # counted from the agents that were infected before the log started (generation 0)
+    infected = contacts['infected'] == 1
+    target = contacts['target'][infected]
+    source = contacts['source'][infected]
+
+    generation = np.zeros(max(target.max(initial=-1), source.max(initial=-1)) + 1, dtype=int)
+    while True:
+        updated = generation[source] + 1
+        if np.array_equal(generation[target], updated):
+            break
+        generation[target] = updated
+
+    return {'target': target, 'source': source, 'time': contacts['time'][infected], 'generation': generation[target]}
+
+
+def reproduction_numbers(header, contacts, until=None):
+    # Mean number of agents infected per infectious agent, per type of the infectious agent (R), and per type of the
+    # infectious and infected agent (the next generation matrix). Counted over the agents that were infectious when the
+    # log started and the agents infected later; with until only agents infected before until are counted, so that
+    # agents infected near the end of the run, that had no time to infect others, do not lower the estimate.
+    agent_types = header['agent_types']
+    type_ids = np.array(header['type_ids'], dtype=int)
+    tree = transmission_tree(contacts)
+
+    infectious = np.zeros(len(type_ids), dtype=bool)
+    infectious[np.array(header['infectious_ids'], dtype=int)] = True
+    infectious[tree['target'][tree['time'] < until] if until is not None else tree['target']] = True
+
+    counted = infectious[tree['source']]
+    infections = np.zeros((len(agent_types), len(agent_types)))
+    np.add.at(infections, (type_ids[tree['source'][counted]], type_ids[tree['target'][counted]]), 1)
+    infectors = np.bincount(type_ids[infectious], minlength=len(agent_types))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        matrix = infections / infectors[:, None]
+        reproduction_number = infections.sum(axis=1) / infectors
+
+    return {'agent_types': agent_types, 'infectors': infectors, 'R': reproduction_number, 'next_generation_matrix': matrix}
+
+
+def attribute_infections(targets, probability, infected, random):
+    # Whether each exposure (targets, probability) infected its target, given the infected targets from the combined
+    # draw of disease.infection_draw. Every infected target gets one of its exposures as cause, chosen with a
+    # probability proportional to the infection probability of the exposure.
+    outcome = np.zeros(len(targets), dtype=np.int8)
+    candidates = np.nonzero(np.isin(targets, infected) & (probability > 0))[0]
+    if len(candidates) == 0:
+        return outcome
+
+    order = candidates[np.argsort(targets[candidates], kind='stable')]
+    cumulative = np.cumsum(probability[order])
+    starts = np.flatnonzero(np.concatenate(([True], targets[order][1:] != targets[order][:-1])))
+    ends = np.append(starts[1:], len(order))
+    before = np.concatenate(([0], cumulative))[starts]
+
+    draws = before + random.random(len(starts))*(cumulative[ends - 1] - before)
+    chosen = np.clip(np.searchsorted(cumulative, draws, side='right'), starts, ends - 1)
+    outcome[order[chosen]] = 1
+
+    return outcome
+
+
+def infectious_ids(states):
+    return np.nonzero((np.asarray(states) == INCUBATING) | (np.asarray(states) == SICK))[0]
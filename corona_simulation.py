@@ -6,62 +6,58 @@ Created on June 22, 2020
 # !/usr/bin/python
 # -*- coding: utf8 -*-
 
+import sys
+import json
 import numpy as np
+from parameter_specs import resolve_parameters, serialize_parameters
 from system import System
 
 
-def main():
+# System Norms & Boundary Conditions
+def vector_difference(vec1, vec2, box):
+    x1 = (vec2[0] - vec1[0]) % box[0]
+    x2 = (vec1[0] - vec2[0]) % box[0]
 
-    # System Norms & Boundary Conditions
-    def vector_difference(vec1, vec2, box):
-        x1 = (vec2[0] - vec1[0]) % box[0]
-        x2 = (vec1[0] - vec2[0]) % box[0]
+    y1 = (vec2[1] - vec1[1]) % box[1]
+    y2 = (vec1[1] - vec2[1]) % box[1]
 
-        y1 = (vec2[1] - vec1[1]) % box[1]
-        y2 = (vec1[1] - vec2[1]) % box[1]
+    if x1 < x2:
+        x = x1
+    else:
+        x = -x2
 
-        if x1 < x2:
-            x = x1
-        else:
-            x = -x2
+    if y1 < y2:
+        y = y1
+    else:
+        y = -y2
 
-        if y1 < y2:
-            y = y1
-        else:
-            y = -y2
+    return np.array([x, y])
 
-        return np.array([x, y])
 
-    def norm(vec1, vec2, box, minimum=0):
-        return max(np.linalg.norm(vector_difference(vec1, vec2, box)), minimum)
+def norm(vec1, vec2, box, minimum=0):
+    return max(np.linalg.norm(vector_difference(vec1, vec2, box)), minimum)
 
-    def boundary_condition(position, velocity, box):
-        for index, coordinate in enumerate(position):
-            position[index] = position[index] % box[index]
 
-        return position, velocity
+def boundary_condition(position, velocity, box):
+    for index, coordinate in enumerate(position):
+        position[index] = position[index] % box[index]
 
-    def force(r, c=10):
-        return -12*c*np.power(r+0.1, -13) + 6*c*np.power(r+0.1, -7)
+    return position, velocity
 
-    def energy_drift_compensation(v, s=0.25, vmax=1, clipspeed=1000):
-        v_norm = np.linalg.norm(v)
-        v_clipped = min(v_norm, clipspeed)
-        return (v/v_norm)*vmax*(1/(1+np.exp(-s*v_clipped)) - 1/2)
 
-    def disease_profile(r, r0, p):
-        if r < r0:
-            return p
-        else:
-            return 0.0
+def force(r, c=10):
+    return -12*c*np.power(r+0.1, -13) + 6*c*np.power(r+0.1, -7)
 
-    def infection_profile(r, r0, p):
-        if r < r0:
-            return p
-        else:
-            return 0.0
 
-    system_params = {
+def energy_drift_compensation(v, s=0.25, vmax=1, clipspeed=1000):
+    v_norm = np.linalg.norm(v)
+    v_clipped = min(v_norm, clipspeed)
+    return (v/v_norm)*vmax*(1/(1+np.exp(-s*v_clipped)) - 1/2)
+
+
+def system_parameters():
+    # System parameters of the healthy/old/young scenario
+    return {
         'DT': 1e0,
         'MAXSTEP': 400,
         'box': np.array([125, 125]),
@@ -94,6 +90,17 @@ def main():
         'energy_drift_compensation_clipspeed': 1000
     }
 
+
+def healthy_old_young(r0=4, recover_probability=None, disease_probability=None, population=None):
+    # Scenario of healthy, old and young agents, with a few sick agents to start the epidemic. Returns the system
+    # parameters and a list of (group name, agent parameters, number of agents) for the groups 'Healthy', 'Sick', 'Old'
+    # and 'Young'. The range r0 of the disease, and dictionaries of group name to recover probability, disease
+    # probability and number of agents override the defaults below.
+    system_params = system_parameters()
+    recover_probability = dict({'Healthy': 1.0, 'Sick': 0.95, 'Old': 0.80, 'Young': 0.95}, **(recover_probability or {}))
+    disease_probability = dict({'Healthy': 0.75, 'Sick': 0.70, 'Old': 0.90, 'Young': 0.40}, **(disease_probability or {}))
+    population = dict({'Healthy': 56, 'Sick': 4, 'Old': 20, 'Young': 20}, **(population or {}))
+
     healthy_agent_parameters = {
         'status': 0,
         'immobile': False,
@@ -105,13 +112,13 @@ def main():
         'healthy_velocity': 1,
         'incubation_velocity': 1,
         'sickness_velocity': 1,
-        'recoverProbability': 1.0,
-        'timeToRecover': lambda: int(np.random.normal(80, 10)),
-        'timeToDie': lambda: int(np.random.normal(50, 10)),
-        'timeToIncubate': lambda: int(np.random.normal(50, 15)),
+        'recoverProbability': recover_probability['Healthy'],
+        'timeToRecover': 'normal(80, 10) as int',
+        'timeToDie': 'normal(50, 10) as int',
+        'timeToIncubate': 'normal(50, 15) as int',
         'box': system_params['box'],
-        'disease_profile': lambda r: disease_profile(r, 4, 0.75),
-        'infection_profile': lambda r: infection_profile(r, 4, 0.75)
+        'disease_profile': 'step(r0=' + str(r0) + ', p=' + str(disease_probability['Healthy']) + ')',
+        'infection_profile': 'step(r0=' + str(r0) + ', p=0.75)'
     }
 
     sick_agent_parameters = {
@@ -125,13 +132,13 @@ def main():
         'healthy_velocity': 1,
         'incubation_velocity': 1,
         'sickness_velocity': 1,
-        'recoverProbability': 0.95,
-        'timeToRecover': lambda: int(np.random.normal(80, 10)),
-        'timeToDie': lambda: int(np.random.normal(50, 10)),
-        'timeToIncubate': lambda: int(np.random.normal(50, 15)),
+        'recoverProbability': recover_probability['Sick'],
+        'timeToRecover': 'normal(80, 10) as int',
+        'timeToDie': 'normal(50, 10) as int',
+        'timeToIncubate': 'normal(50, 15) as int',
         'box': system_params['box'],
-        'disease_profile': lambda r: disease_profile(r, 4, 0.70),
-        'infection_profile': lambda r: infection_profile(r, 4, 0.70)
+        'disease_profile': 'step(r0=' + str(r0) + ', p=' + str(disease_probability['Sick']) + ')',
+        'infection_profile': 'step(r0=' + str(r0) + ', p=0.70)'
     }
 
     old_agent_parameters = {
@@ -145,13 +152,13 @@ def main():
         'healthy_velocity': 1,
         'incubation_velocity': 1,
         'sickness_velocity': 1,
-        'recoverProbability': 0.80,
-        'timeToRecover': lambda: int(np.random.normal(80, 10)),
-        'timeToDie': lambda: int(np.random.normal(50, 10)),
-        'timeToIncubate': lambda: int(np.random.normal(50, 15)),
+        'recoverProbability': recover_probability['Old'],
+        'timeToRecover': 'normal(80, 10) as int',
+        'timeToDie': 'normal(50, 10) as int',
+        'timeToIncubate': 'normal(50, 15) as int',
         'box': system_params['box'],
-        'disease_profile': lambda r: disease_profile(r, 4, 0.90),
-        'infection_profile': lambda r: infection_profile(r, 4, 0.70)
+        'disease_profile': 'step(r0=' + str(r0) + ', p=' + str(disease_probability['Old']) + ')',
+        'infection_profile': 'step(r0=' + str(r0) + ', p=0.70)'
     }
 
     young_agent_parameters = {
@@ -165,32 +172,65 @@ def main():
         'healthy_velocity': 1,
         'incubation_velocity': 1,
         'sickness_velocity': 1,
-        'recoverProbability': 0.95,
-        'timeToRecover': lambda: int(np.random.normal(80, 10)),
-        'timeToDie': lambda: int(np.random.normal(50, 10)),
-        'timeToIncubate': lambda: int(np.random.normal(50, 15)),
+        'recoverProbability': recover_probability['Young'],
+        'timeToRecover': 'normal(80, 10) as int',
+        'timeToDie': 'normal(50, 10) as int',
+        'timeToIncubate': 'normal(50, 15) as int',
         'box': system_params['box'],
-        'disease_profile': lambda r: disease_profile(r, 4, 0.40),
-        'infection_profile': lambda r: infection_profile(r, 4, 0.70)
+        'disease_profile': 'step(r0=' + str(r0) + ', p=' + str(disease_probability['Young']) + ')',
+        'infection_profile': 'step(r0=' + str(r0) + ', p=0.70)'
     }
 
-    system = System(system_params)
+    return system_params, [('Healthy', healthy_agent_parameters, population['Healthy']),
+                           ('Sick', sick_agent_parameters, population['Sick']),
+                           ('Old', old_agent_parameters, population['Old']),
+                           ('Young', young_agent_parameters, population['Young'])]
+
+
+def load_scenario(path):
+    # Scenario from a JSON file {"system": {...}, "populations": [{"name": ..., "count": ..., "parameters": {...}}]}.
+    # System parameters missing from the file are taken from system_parameters(), agent parameters are given as
+    # numbers or spec strings (see parameter_specs.py), and take DT and box from the system when they are left out.
+    with open(path, encoding='utf-8') as file:
+        scenario = json.load(file)
+
+    system_params = dict(system_parameters(), **scenario.get('system', {}))
+    system_params['box'] = np.array(system_params['box'])
+
+    populations = []
+    for population in scenario['populations']:
+        agent_parameters = dict({'DT': system_params['DT'], 'box': system_params['box']}, **population['parameters'])
+        agent_parameters['box'] = np.array(agent_parameters['box'])
+        populations.append((population['name'], resolve_parameters(agent_parameters), population['count']))
+
+    return system_params, populations
+
+
+def save_scenario(path, system_params, populations):
+    # Write a scenario as JSON, the inverse of load_scenario. Callable system parameters are left out (load_scenario
+    # takes them from system_parameters()), agent parameters have to be numbers or specs.
+    system = {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in system_params.items() if not callable(value)}
+
+    scenario = {'system': system, 'populations': []}
+    for name, agent_parameters, count in populations:
+        parameters = {key: value for key, value in agent_parameters.items() if key not in ('DT', 'box')}
+        scenario['populations'].append({'name': name, 'count': count, 'parameters': serialize_parameters(parameters)})
+
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(scenario, file, indent=4)
 
-    print('Adding Healthy Agents...')
-    for i in range(56):
-        system.add_agent(healthy_agent_parameters)
 
-    print('Adding Sick Agents...')
-    for i in range(4):
-        system.add_agent(sick_agent_parameters)
+def main(system_class=System, scenario_file=None):
+    if scenario_file is not None:
+        system_params, populations = load_scenario(scenario_file)
+    else:
+        system_params, populations = healthy_old_young()
 
-    print('Adding Old Agents...')
-    for i in range(20):
-        system.add_agent(old_agent_parameters)
+    system = system_class(system_params)
 
-    print('Adding Young Agents...')
-    for i in range(20):
-        system.add_agent(young_agent_parameters)
+    for name, agent_parameters, count in populations:
+        print('Adding ' + name + ' Agents...')
+        system.add_agents(agent_parameters, count)
 
     print('Running Simulations')
     system.run()
@@ -200,4 +240,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    main(scenario_file=sys.argv[1] if len(sys.argv) > 1 else None)
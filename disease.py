@@ -0,0 +1,58 @@
+import numpy as np
+
+# Disease states, as used by Agent
+SUSCEPTIBLE = 0
+INCUBATING = 1
+SICK = 2
+RECOVERED = 3
+DEAD = 4
+NUMBER_OF_STATES = 5
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Batched disease state machine. All functions work in place on per-agent arrays, replacing the per-agent Counter
+# objects and Agent.handle_state: a countdown array holds the number of steps left in the incubating or sick state.
+# ----------------------------------------------------------------------------------------------------------------------
+def progress_states(state, countdown, will_recover, time_to_recover, time_to_die):
+    # Count down all incubating and sick agents, and move the ones whose time is up to their next state.
+    # Returns the indices of the agents that became sick, recovered and died.
+    active = (state == INCUBATING) | (state == SICK)
+    countdown[active] -= 1
+    expired = active & (countdown <= 0)
+
+    incubated = expired & (state == INCUBATING)
+    sick = np.nonzero(incubated)[0]
+    recovered = np.nonzero(expired & ~incubated & will_recover)[0]
+    died = np.nonzero(expired & ~incubated & ~will_recover)[0]
+
+    state[sick] = SICK
+    countdown[sick] = np.where(will_recover[sick], time_to_recover[sick], time_to_die[sick])
+    state[recovered] = RECOVERED
+    state[died] = DEAD
+
+    return sick, recovered, died
+
+
+def infection_draw(targets, probability, number_of_agents, random):
+    # Combine all infection attempts on the same target, 1 - prod(1 - p), and decide all targets with one draw.
+    # This is equivalent to one draw per attempt, but only needs one random number per exposed agent.
+    log_escape = np.bincount(targets, weights=np.log1p(-np.minimum(probability, 1)), minlength=number_of_agents)
+    exposed = np.unique(targets)
+    infected = random(len(exposed)) < -np.expm1(log_escape[exposed])
+
+    return exposed[infected]
+
+
+def infect(state, countdown, time_to_incubate, infected):
+    state[infected] = INCUBATING
+    countdown[infected] = time_to_incubate[infected]
+
+
+def state_speed(state, healthy_velocity, incubation_velocity, sickness_velocity):
+    # Speed of agents in their current state
+    speed = np.zeros(len(state))
+    speed[(state == SUSCEPTIBLE) | (state == RECOVERED)] = healthy_velocity[(state == SUSCEPTIBLE) | (state == RECOVERED)]
+    speed[state == INCUBATING] = incubation_velocity[state == INCUBATING]
+    speed[state == SICK] = sickness_velocity[state == SICK]
+
+    return speed
@@ -0,0 +1,139 @@
+import itertools
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+from vectorized_system import VectorizedSystem
+from replica_system import ReplicaSystem
+
+
+def sweep_points(sweep):
+    # All combinations of the values in a sweep grid {name: [values]}, as keyword arguments for the scenario
+    names = list(sweep)
+    return [dict(zip(names, values)) for values in itertools.product(*(sweep[name] for name in names))]
+
+
+def run_replicate(scenario, point, seed, system_class=VectorizedSystem):
+    # One realization of a scenario, without rendering or writing files. The scenario is a module level function that
+    # returns the system parameters and a list of (name, agent parameters, number of agents), like
+    # corona_simulation.healthy_old_young, so only the function and its arguments are sent to the worker process.
+    # The system gets its own generator from the seed, and the global generators used by the callable agent parameters
+    # are seeded from it as well. The run stops once the disease is extinct, which does not change the measurements.
+    # Returns the agent types, counts as (measurements, types, states) and the times.
+    system_seed, global_seed = np.random.SeedSequence(seed).spawn(2)
+    np.random.seed(global_seed.generate_state(1)[0])
+    random.seed(int(global_seed.generate_state(1)[0]))
+
+    system_params, populations = scenario(**point)
+    system = system_class(dict(system_params, seed=system_seed, render_stride=0, print_interval=0, measurements_file=None, measurements_stream_file=None,
+                               extinction_fast_forward=True, extinction_render_stride=0))
+    for name, agent_parameters, count in populations:
+        system.add_agents(agent_parameters, count)
+    system.run()
+
+    return measurement_curves(system.measurements)
+
+
+def run_replicas(scenario, point, seeds):
+    # Realizations of a scenario for all seeds at once, as the replicas of one ReplicaSystem. Replica k gets the same
+    # system seed as run_replicate(scenario, point, seeds[k]); the global generators are seeded from the first seed.
+    # Returns a list of the results of run_replicate.
+    seed_sequences = [np.random.SeedSequence(seed).spawn(2) for seed in seeds]
+    global_seed = seed_sequences[0][1]
+    np.random.seed(global_seed.generate_state(1)[0])
+    random.seed(int(global_seed.generate_state(1)[0]))
+
+    system_params, populations = scenario(**point)
+    system = ReplicaSystem(dict(system_params, replicas=len(seeds), replica_seeds=[system_seed for system_seed, _ in seed_sequences],
+                                render_stride=0, print_interval=0, measurements_file=None, measurements_stream_file=None,
+                                extinction_fast_forward=True, extinction_render_stride=0))
+    for name, agent_parameters, count in populations:
+        system.add_agents(agent_parameters, count)
+    system.run()
+
+    return [measurement_curves(measurements) for measurements in system.measurements]
+
+
+def measurement_curves(measurements):
+    # Agent types, counts as (measurements, types, states) and the times of {type: rows} measurements
+    agent_types = list(measurements)
+    counts = np.array([[row[:-1] for row in measurements[agent_type]] for agent_type in agent_types]).transpose(1, 0, 2)
+    time = np.array([row[-1] for row in measurements[agent_types[0]]])
+
+    return agent_types, counts, time
+
+
+class CurveAggregator:
+    # Mean and quantiles of the state counts over replicates, without keeping the replicates. Counts are integers
+    # between 0 and the population size, so a histogram of the values seen for every measurement, type and state gives
+    # exact quantiles, and its size does not depend on the number of replicates.
+    def __init__(self):
+        self.replicates = 0
+        self.agent_types = None
+        self.time = None
+        self.total = None
+        self.histogram = None
+
+    def add(self, agent_types, counts, time):
+        if self.histogram is None:
+            self.agent_types = agent_types
+            self.time = time
+            self.total = np.zeros(counts.shape)
+            self.histogram = np.zeros(counts.shape + (counts.sum(axis=2).max() + 1,), dtype=np.int64)
+        else:
+            counts = counts[:, [agent_types.index(agent_type) for agent_type in self.agent_types]]
+
+        bins = self.histogram.shape[-1]
+        flat_index = np.arange(counts.size)*bins + counts.ravel()
+        self.histogram += np.bincount(flat_index, minlength=self.histogram.size).reshape(self.histogram.shape)
+        self.total += counts
+        self.replicates += 1
+
+    def mean(self):
+        return self.total / self.replicates
+
+    def quantile(self, q):
+        cumulative = np.cumsum(self.histogram, axis=-1)
+        return np.argmax(cumulative >= max(np.ceil(q*self.replicates), 1), axis=-1)
+
+
+def run_ensemble(scenario, sweep, seeds, workers=None, quantiles=(0.05, 0.5, 0.95), system_class=VectorizedSystem, replicas=1):
+    # Runs every combination of the sweep grid once for every seed on a pool of worker processes, and aggregates the
+    # state counts per combination as the replicates finish. The same seeds are used for every combination, so
+    # differences between combinations are not blurred by different random numbers. With replicas > 1, every task
+    # runs that many seeds at once as the replicas of a ReplicaSystem (system_class is then not used), which is faster
+    # for small populations.
+    # Returns per combination its parameters, the number of replicates, the agent types, the times of the measurements,
+    # and the mean and quantiles of the counts as (measurements, types, states) arrays.
+    points = sweep_points(sweep)
+    seeds = list(seeds)
+    aggregators = [CurveAggregator() for _ in points]
+    workers = workers if workers is not None else os.cpu_count()
+
+    def collect(done):
+        for future in done:
+            index = pending.pop(future)
+            for result in (future.result() if replicas > 1 else [future.result()]):
+                aggregators[index].add(*result)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        for index, point in enumerate(points):
+            for start in range(0, len(seeds), replicas):
+                # Keep a bounded number of replicates in flight, so finished results are aggregated and released
+                while len(pending) >= 2*workers:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                if replicas > 1:
+                    pending[executor.submit(run_replicas, scenario, point, seeds[start:start + replicas])] = index
+                else:
+                    pending[executor.submit(run_replicate, scenario, point, seeds[start], system_class)] = index
+
+        while len(pending) > 0:
+            collect(wait(pending, return_when=FIRST_COMPLETED).done)
+
+    return [{'parameters': point,
+             'replicates': aggregator.replicates,
+             'agent_types': aggregator.agent_types,
+             'time': aggregator.time,
+             'mean': aggregator.mean(),
+             'quantiles': {q: aggregator.quantile(q) for q in quantiles}} for point, aggregator in zip(points, aggregators)]
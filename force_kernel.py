@@ -0,0 +1,118 @@
+import numpy as np
+
+
+def evaluate_force(force, r, force_constant):
+    # Evaluate a radial force function on an array of distances, element-wise if it is written for scalars only
+    try:
+        values = np.asarray(force(r, force_constant), dtype=float)
+        if values.shape == r.shape:
+            return values
+    except (ValueError, TypeError):
+        pass
+
+    return np.vectorize(lambda distance: force(distance, force_constant), otypes=[float])(r)
+
+
+class ForceKernel:
+    # Radial force force(r, force_constant) tabulated on table_size evenly spaced distances from 0 to cutoff, and
+    # evaluated on whole arrays of distances by linear interpolation between the table entries, which only costs a
+    # multiplication, an index lookup and a multiply-add per pair instead of evaluating the force function. The force
+    # is 0 beyond the cutoff. Near r = 0 the repulsion is too steep to interpolate: below core_distance, the end of the
+    # last table interval where the relative interpolation error exceeds core_tolerance, the force function itself is
+    # evaluated. The interpolation error is measured from min_distance (by default 0) to the cutoff.
+    def __init__(self, force, force_constant, cutoff, table_size=16384, min_distance=0.0, core_tolerance=1e-4):
+        self.force = force
+        self.force_constant = force_constant
+        self.cutoff = float(cutoff)
+        self.table_size = table_size
+
+        self.spacing = self.cutoff / (table_size - 1)
+        self.inverse_spacing = 1 / self.spacing
+        self.table = evaluate_force(force, np.linspace(0, self.cutoff, table_size), force_constant)
+        self.slope = np.append(np.diff(self.table), 0)
+        self.table_values = self.table.tolist()
+        self.slope_values = self.slope.tolist()
+
+        # Steep core, evaluated with the force function
+        self.core_tolerance = core_tolerance
+        self.core_distance = 0.0
+        r = self.sample_distances()
+        relative_error = self.table_error(r)[1]
+        steep = np.nonzero(relative_error > core_tolerance)[0]
+        if len(steep) > 0:
+            self.core_distance = min((np.floor(r[steep[-1]] * self.inverse_spacing) + 1) * self.spacing, self.cutoff)
+
+        # Potential energy of a pair, the force integrated from the cutoff inwards (trapezoidal rule), so that
+        # force = -d(potential)/dr along the displacement from the other agent and the potential is 0 at the cutoff
+        segments = (self.table[:-1] + self.table[1:]) / 2 * self.spacing
+        self.potential_table = np.append(np.cumsum(segments[::-1])[::-1], 0)
+        self.potential_slope = np.append(np.diff(self.potential_table), 0)
+
+        self.min_distance = float(min_distance)
+        self.max_error, self.max_relative_error, self.max_error_distance = self.interpolation_error()
+
+    def __call__(self, r):
+        if isinstance(r, float):
+            # Single distance, as used by System for every pair, without the overhead of array operations
+            if r < self.core_distance:
+                return float(self.force(r, self.force_constant))
+            x = r * self.inverse_spacing
+            if x > self.table_size - 1:
+                return 0.0
+            index = int(x)
+            return self.table_values[index] + (x - index)*self.slope_values[index]
+
+        r = np.asarray(r, dtype=float)
+        values = self.interpolate(self.table, self.slope, r)
+        core = r < self.core_distance
+        if core.any():
+            values[core] = evaluate_force(self.force, r[core], self.force_constant)
+
+        return values
+
+    def potential(self, r):
+        return self.interpolate(self.potential_table, self.potential_slope, r)
+
+    def interpolate(self, table, slope, r):
+        x = np.asarray(r, dtype=float) * self.inverse_spacing
+        index = np.minimum(x.astype(np.intp), self.table_size - 1)
+        values = table[index] + (x - index)*slope[index]
+
+        return np.where(x <= self.table_size - 1, values, 0.0)
+
+    def sample_distances(self, samples=4):
+        # samples points inside every table interval, as linear interpolation is least accurate half-way between entries
+        fractions = (np.arange(samples) + 0.5) / samples
+        return ((np.arange(self.table_size - 1)[:, None] + fractions) * self.spacing).ravel()
+
+    def table_error(self, r, interpolated=None):
+        # Absolute and relative difference with the force function at the distances r, of the plain table or of the
+        # interpolated values given. The relative error is taken against the size of the force, but at least the force
+        # at the cutoff, as smaller forces are dropped by the cutoff anyway.
+        if interpolated is None:
+            interpolated = self.interpolate(self.table, self.slope, r)
+        exact = evaluate_force(self.force, r, self.force_constant)
+        floor = max(abs(self.table[-1]), np.finfo(float).tiny)
+        with np.errstate(invalid='ignore'):
+            error = np.abs(interpolated - exact)
+            relative_error = error / np.maximum(np.abs(exact), floor)
+
+        return np.nan_to_num(error, nan=np.inf), np.nan_to_num(relative_error, nan=np.inf)
+
+    def interpolation_error(self):
+        # Largest difference of the kernel with the force function from min_distance to the cutoff. Returns the
+        # absolute and relative error and the distance where the absolute error is largest.
+        r = self.sample_distances()
+        r = r[r >= self.min_distance]
+        if len(r) == 0:
+            return 0.0, 0.0, self.min_distance
+        error, relative_error = self.table_error(r, self(r))
+        largest = np.argmax(error)
+
+        return error[largest], np.max(relative_error), r[largest]
+
+    def describe(self):
+        return ('Force table: ' + str(self.table_size) + ' entries up to r = ' + str(self.cutoff) + ', force function below r = '
+                + '{:.3g}'.format(self.core_distance) + ', maximum interpolation error from r = ' + '{:.3g}'.format(self.min_distance) + ' '
+                + '{:.3g}'.format(self.max_error) + ' at r = ' + '{:.3g}'.format(self.max_error_distance)
+                + ' (relative ' + '{:.3g}'.format(self.max_relative_error) + ')')
@@ -0,0 +1,116 @@
+import numpy as np
+from cell_list import minimum_image
+
+# Integrators of the vectorized engine, selected with the 'integrator' system parameter. Each one advances the
+# positions and velocities of all agents by one time step DT, given the interacting pairs at the start of the step,
+# and returns the number of substeps it took.
+#
+#   euler:    explicit Euler, with the energy drift compensation as speed limit (the original scheme)
+#   verlet:   velocity Verlet, without speed limit
+#   adaptive: velocity Verlet, where agents in a close encounter take up to max_substeps smaller steps, so that none of
+#             them moves more than adaptive_accuracy times the distance to its nearest neighbour per substep. All
+#             other agents keep the full step.
+#             The energy drift is only bounded by a small adaptive_accuracy: at DT = 1 the total energy drifts by about
+#             28% over 400 steps with 0.1, 1.5% with 0.03 and 0.1% with the default 0.02.
+
+
+def kick(system, force, agents, dt):
+    system.velocity[agents] += force[agents] / system.mass[agents, None] * dt
+
+
+def euler(system, pairs):
+    force = system.current_force(pairs)
+
+    mobile = ~system.immobile
+    velocity = system.velocity[mobile] + (force[mobile] / system.mass[mobile, None])*system.DT
+    system.velocity[mobile] = system.vectorized_energy_drift_compensation(velocity, system.energy_drift_compensation_slope, system.energy_drift_compensation_vmax, system.energy_drift_compensation_clipspeed)
+    system.velocity[system.immobile] = 0
+
+    system.position = system.position + system.velocity * system.DT
+    system.apply_boundary_conditions()
+
+    return 1
+
+
+def velocity_verlet(system, pairs):
+    force = system.current_force(pairs)
+
+    mobile = ~system.immobile
+    system.velocity[system.immobile] = 0
+
+    kick(system, force, mobile, system.DT / 2)
+    system.position = system.position + system.velocity * system.DT
+    system.apply_boundary_conditions()
+
+    # The force at the new positions completes this step, and is kept for the start of the next one
+    force = system.current_force(system.neighbor_pairs())
+    kick(system, force, mobile, system.DT / 2)
+
+    return 1
+
+
+def encounter_substeps(system, pairs, force):
+    # Number of substeps every agent needs, so that with its current speed and acceleration it does not move more
+    # than adaptive_accuracy times the distance to its nearest neighbour in one substep
+    i, j, displacement, r = pairs
+    nearest = np.full(system.number_of_agents, np.inf)
+    np.minimum.at(nearest, i, r)
+
+    allowed = system.adaptive_accuracy * nearest
+    speed = np.linalg.norm(system.velocity, axis=1)
+    acceleration = np.linalg.norm(force, axis=1) / system.mass
+
+    # Largest dt with speed*dt + acceleration*dt^2/2 <= allowed
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dt = np.where(acceleration > 0, (np.sqrt(speed**2 + 2*acceleration*allowed) - speed) / acceleration, allowed / speed)
+        substeps = np.ceil(system.DT / dt)
+
+    return np.clip(np.nan_to_num(substeps, nan=1), 1, system.max_substeps).astype(int)
+
+
+def adaptive_velocity_verlet(system, pairs):
+    force = system.current_force(pairs)
+
+    mobile = ~system.immobile
+    system.velocity[system.immobile] = 0
+
+    substeps = encounter_substeps(system, pairs, force)
+    close = mobile & (substeps > 1)
+    if not close.any():
+        return velocity_verlet(system, pairs)
+    far = mobile & ~close
+    steady = ~close
+
+    # Agents that are not in a close encounter take the first half of a full velocity Verlet step, and move in a
+    # straight line over the step while the agents in close encounters take the substeps
+    kick(system, force, far, system.DT / 2)
+    start = system.position
+    position = start.copy()
+
+    # The forces on the close agents are recomputed every substep, from the pairs they were in at the start
+    i, j, displacement, r = system.solid_pairs(pairs)
+    encounter = close[i]
+    i, j = i[encounter], j[encounter]
+
+    number_of_substeps = substeps[close].max()
+    dt = system.DT / number_of_substeps
+    close_force = force
+    for substep in range(number_of_substeps):
+        kick(system, close_force, close, dt / 2)
+        position[close] += system.velocity[close] * dt
+        position[steady] = start[steady] + system.velocity[steady] * (substep + 1)*dt
+
+        displacement = minimum_image(position[i] - position[j], system.box)
+        close_force = system.pair_forces(i, j, displacement, np.linalg.norm(displacement, axis=1))
+        kick(system, close_force, close, dt / 2)
+
+    system.position = position
+    system.apply_boundary_conditions()
+
+    force = system.current_force(system.neighbor_pairs())
+    kick(system, force, far, system.DT / 2)
+
+    return number_of_substeps
+
+
+INTEGRATORS = {'euler': euler, 'verlet': velocity_verlet, 'adaptive': adaptive_velocity_verlet}
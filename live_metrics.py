@@ -0,0 +1,174 @@
+import json
+import asyncio
+import threading
+from collections import deque
+
+
+class MetricsServer:
+    # Live metrics of a running simulation over HTTP on localhost. The step loop hands events to publish, which only
+    # appends them to a bounded deque (dropping the oldest event when it is full), so publishing never waits for the
+    # server or its clients. An asyncio event loop in a background thread takes the events from the deque every
+    # poll_interval seconds and sends them to the clients:
+    #
+    #   GET /events   a stream of server-sent events, 'event: <kind>' with the event as JSON data
+    #   GET /metrics  the latest event of every kind as one JSON object
+    #
+    # Every client has its own queue of queue_size events, which also drops the oldest event when the client does not
+    # keep up, so a slow client only misses events and never holds up the others or the simulation.
+    def __init__(self, host='127.0.0.1', port=0, queue_size=256, poll_interval=0.05):
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+
+        self.events = deque(maxlen=queue_size)
+        self.latest = {}
+        self.clients = set()
+        self.dropped = 0
+
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.closing = False
+        self.close_timeout = 1.0
+
+    def start(self):
+        # Start the event loop thread, and wait until the server listens. With port 0 a free port is chosen.
+        started = threading.Event()
+        errors = []
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            try:
+                self.server = self.loop.run_until_complete(asyncio.start_server(self.handle_client, self.host, self.port))
+            except OSError as error:
+                errors.append(error)
+                started.set()
+                self.loop.close()
+                return
+
+            self.port = self.server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_until_complete(self.pump())
+            self.loop.close()
+
+        self.thread = threading.Thread(target=serve, name='live-metrics', daemon=True)
+        self.thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+
+    def url(self, path='/events'):
+        return 'http://' + self.host + ':' + str(self.port) + path
+
+    def publish(self, kind, event):
+        # Called from the step loop: the event is a dictionary that is not changed afterwards
+        self.events.append((kind, event))
+
+    def close(self, timeout=1.0):
+        # Send the remaining events, end the event streams and stop the server, waiting at most timeout seconds for
+        # clients to receive the last events
+        if self.thread is None:
+            return
+
+        self.close_timeout = timeout
+        self.closing = True
+        self.thread.join(timeout + 2*self.poll_interval)
+        self.thread = None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Handle Event Loop
+    # ------------------------------------------------------------------------------------------------------------------
+    def dispatch(self):
+        # Move the published events to the queues of the clients
+        while self.events:
+            kind, event = self.events.popleft()
+            message = (kind, json.dumps(event, separators=(',', ':')))
+            self.latest[kind] = event
+
+            for queue in self.clients:
+                if queue.full():
+                    queue.get_nowait()
+                    self.dropped += 1
+                queue.put_nowait(message)
+
+    async def pump(self):
+        while not self.closing:
+            self.dispatch()
+            await asyncio.sleep(self.poll_interval)
+
+        self.dispatch()
+        self.server.close()
+        for queue in self.clients:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+        # Give the clients time to receive the last events, then drop the ones still sending
+        clients = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if clients:
+            done, pending = await asyncio.wait(clients, timeout=self.close_timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def handle_client(self, reader, writer):
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            path = request[1].split('?')[0] if len(request) > 1 else ''
+
+            if path == '/events':
+                await self.stream_events(writer)
+            elif path == '/metrics':
+                body = json.dumps(self.latest, separators=(',', ':')).encode('utf-8')
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: ' + str(len(body)).encode('ascii') + b'\r\nConnection: close\r\n\r\n' + body)
+                await writer.drain()
+            else:
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def stream_events(self, writer):
+        queue = asyncio.Queue(self.queue_size)
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n')
+
+        # A new client starts with the latest event of every kind
+        for kind, event in self.latest.items():
+            writer.write(server_sent_event(kind, json.dumps(event, separators=(',', ':'))))
+
+        self.clients.add(queue)
+        try:
+            while True:
+                await writer.drain()
+                message = await queue.get()
+                if message is None:
+                    return
+                writer.write(server_sent_event(*message))
+        finally:
+            self.clients.discard(queue)
+
+
+def server_sent_event(kind, data):
+    return ('event: ' + kind + '\ndata: ' + data + '\n\n').encode('utf-8')
+
+
+def read_events(url, timeout=10):
+    # Client for scripts and tests: yields the (kind, event) pairs of the event stream at url until it ends
+    from urllib.request import urlopen
+
+    with urlopen(url, timeout=timeout) as response:
+        kind, data = None, []
+        for line in response:
+            line = line.decode('utf-8').rstrip('\n')
+            if line.startswith('event: '):
+                kind = line[len('event: '):]
+            elif line.startswith('data: '):
+                data.append(line[len('data: '):])
+            elif line == '' and data:
+                yield kind, json.loads('\n'.join(data))
+                kind, data = None, []
@@ -0,0 +1,82 @@
+import json
+import numpy as np
+from disease import NUMBER_OF_STATES
+
+# Measurement stream file layout: MAGIC, the header length as uint32, a JSON header with the agent types, followed by
+# fixed-width rows of int32. Every row holds the number of agents per type and state, then the time of the measurement.
+MAGIC = b'MDVSMEAS'
+ROW_TYPE = np.dtype('<i4')
+
+
+def count_states(type_ids, states, number_of_types):
+    # Number of agents of every type (rows) in every state (columns)
+    # As intp, since type ids and states may be stored in int8
+    counts = np.bincount(np.asarray(type_ids, dtype=np.intp)*NUMBER_OF_STATES + np.asarray(states), minlength=number_of_types*NUMBER_OF_STATES)
+
+    return counts.reshape(number_of_types, NUMBER_OF_STATES)
+
+
+class MeasurementWriter:
+    # Collects measurements in a preallocated buffer of buffer_rows rows, and appends the buffer to the file whenever
+    # it is full. Rows already flushed can be read with read_measurement_columns while the run is still going.
+    # With resume_rows, an existing file is continued after its first resume_rows rows (when resuming a checkpoint).
+    def __init__(self, path, agent_types, buffer_rows=10, resume_rows=None):
+        self.path = path
+        self.agent_types = list(agent_types)
+        self.buffer = np.zeros((buffer_rows, len(self.agent_types)*NUMBER_OF_STATES + 1), dtype=ROW_TYPE)
+        self.rows = 0
+        self.rows_written = 0
+
+        header = json.dumps({'agent_types': self.agent_types, 'states': NUMBER_OF_STATES}).encode('utf-8')
+        if resume_rows is not None:
+            self.file = open(path, 'r+b')
+            self.file.truncate(len(MAGIC) + 4 + len(header) + resume_rows*self.buffer.shape[1]*ROW_TYPE.itemsize)
+            self.file.seek(0, 2)
+            self.rows_written = resume_rows
+            return
+
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC + np.uint32(len(header)).tobytes() + header)
+        self.file.flush()
+
+    def append(self, counts, time):
+        self.buffer[self.rows, :-1] = np.asarray(counts).ravel()
+        self.buffer[self.rows, -1] = time
+        self.rows += 1
+
+        if self.rows == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer[:self.rows].tobytes())
+        self.file.flush()
+        self.rows_written += self.rows
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_measurement_columns(path):
+    # Agent types, the counts per measurement, type and state as an (rows, types, states) array, and the times.
+    # A partially written last row (of a run still going) is ignored.
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a measurement stream file')
+        header_length = int(np.frombuffer(file.read(4), dtype=np.uint32)[0])
+        header = json.loads(file.read(header_length).decode('utf-8'))
+        data = np.frombuffer(file.read(), dtype=ROW_TYPE)
+
+    agent_types = header['agent_types']
+    columns = len(agent_types)*header['states'] + 1
+    rows = data[:len(data) // columns * columns].reshape(-1, columns)
+
+    return agent_types, rows[:, :-1].reshape(len(rows), len(agent_types), header['states']), rows[:, -1]
+
+
+def read_measurements(path):
+    # Measurements from a stream file, in the same {type: [[susceptible, ..., dead, time], ...]} form as System
+    agent_types, counts, time = read_measurement_columns(path)
+
+    return {agent_type: np.column_stack((counts[:, index], time)).tolist() for index, agent_type in enumerate(agent_types)}
@@ -0,0 +1,237 @@
+import os
+import multiprocessing
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+from cell_list import CellList
+from disease import SUSCEPTIBLE, INCUBATING, SICK, progress_states, infection_draw, infect
+from vectorized_system import VectorizedSystem
+
+
+def domain_worker(system, domain):
+    # Loop of a worker process: wait for the main process to start a step, advance the agents of domain, and wait
+    # until all domains are done. A step time of -1 stops the worker.
+    try:
+        while True:
+            system.step_barrier.wait()
+            if system.clock[0] < 0:
+                return
+            system.domain_step(domain)
+            system.step_barrier.wait()
+    except threading.BrokenBarrierError:
+        return
+    except BaseException:
+        # Release the other processes instead of leaving them waiting for this one
+        system.domain_barrier.abort()
+        system.step_barrier.abort()
+        raise
+
+
+class ParallelSystem(VectorizedSystem):
+    # VectorizedSystem that splits the periodic box into 'domain_workers' strips along x, each advanced by its own
+    # worker process. The agent arrays are moved into shared memory when the first step is taken, so the workers
+    # read and write them in place and nothing is sent between processes during a step.
+    #
+    # A worker owns the agents in its strip: it progresses their disease state, decides their infections and moves
+    # them. It also reads the halo, the agents of the neighbouring strips within interaction_cutoff of its strip, so
+    # that forces and infections across the strip boundaries are counted. Ownership follows the position, so an agent
+    # that crosses a boundary migrates to the neighbouring domain at the next step. A step has three phases, separated
+    # by barriers so no worker reads what another one is writing:
+    #
+    #   1. disease states of the owned agents
+    #   2. neighbour pairs, infections of the owned agents and forces on them, read from the states and positions
+    #      at the end of phase 1 (nothing is written)
+    #   3. the infections are applied and the owned agents are moved
+    #
+    # Every domain draws its infections from its own generator, derived from the seed, the domain and the time, so a
+    # run is reproducible for a given seed and number of domains, and statistically equivalent (not identical) to
+    # VectorizedSystem. Only the 'euler' integrator is supported, and 'interaction_cutoff' is required. Worker
+    # processes are forked, so this only works on platforms that support fork.
+    def __init__(self, parameters):
+        super().__init__(parameters)
+
+        if self.interaction_cutoff is None:
+            raise ValueError('ParallelSystem needs an interaction_cutoff')
+        if self.integrator != 'euler':
+            raise ValueError('ParallelSystem only supports the euler integrator')
+        if self.energy_diagnostics or self.contact_log_file is not None:
+            raise ValueError('ParallelSystem does not support energy diagnostics or a contact log')
+
+        self.domain_workers = parameters.get('domain_workers', os.cpu_count())
+        self.domain_width = self.box[0] / self.domain_workers
+
+        # Generators of the domains are derived from this seed sequence
+        self.domain_seed = self.random.bit_generator.seed_seq
+
+        # Cell list of a worker, rebuilt every step for the agents of its domain and halo
+        self.domain_cell_list = CellList(self.box, self.interaction_cutoff)
+
+        # Shared memory and worker processes, while running
+        self.shared_memory = []
+        self.processes = []
+        self.clock = None
+        self.step_barrier = None
+        self.domain_barrier = None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Handle Worker Processes
+    # ------------------------------------------------------------------------------------------------------------------
+    def share_array(self, array):
+        memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+        shared[...] = array
+        self.shared_memory.append(memory)
+
+        return shared
+
+    def start_workers(self):
+        # Move the agent arrays into shared memory and fork the workers, which inherit them
+        context = multiprocessing.get_context('fork')
+        for name in self.agent_arrays:
+            setattr(self, name, self.share_array(getattr(self, name)))
+        self.clock = self.share_array(np.zeros(1, dtype=np.int64))
+
+        self.step_barrier = context.Barrier(self.domain_workers + 1)
+        self.domain_barrier = context.Barrier(self.domain_workers)
+        self.processes = [context.Process(target=domain_worker, args=(self, domain), daemon=True) for domain in range(self.domain_workers)]
+        for process in self.processes:
+            process.start()
+
+    def close(self):
+        # Stop the workers and move the agent arrays back into the memory of this process
+        if len(self.processes) == 0:
+            return
+
+        self.clock[0] = -1
+        try:
+            self.step_barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+        for process in self.processes:
+            process.join()
+
+        for name in self.agent_arrays:
+            setattr(self, name, np.array(getattr(self, name)))
+        self.clock = None
+        for memory in self.shared_memory:
+            memory.close()
+            memory.unlink()
+        self.shared_memory = []
+        self.processes = []
+
+    def append_agents(self, fields, sampled=()):
+        self.close()
+        super().append_agents(fields, sampled)
+
+    def restore_state(self, header, arrays):
+        self.close()
+        super().restore_state(header, arrays)
+
+    def set_agent_values(self, name, agents, values):
+        # Giving agents their own values of a group parameter makes a new agent array, which the forked workers would
+        # not see, so they are stopped and started again with it at the next step. Other agent arrays are in shared
+        # memory and are changed in place.
+        if name in self.group_parameters and name not in self.agent_parameters:
+            self.close()
+        super().set_agent_values(name, agents, values)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Handle System Simulation
+    # ------------------------------------------------------------------------------------------------------------------
+    def domain_of(self, x):
+        return np.minimum((x / self.domain_width).astype(int), self.domain_workers - 1)
+
+    def domain_agents(self, domain):
+        # Agents owned by domain, the agents of the domain and its halo, and which of those are owned
+        x = self.position[:, 0]
+        owned = self.domain_of(x) == domain
+        halo = self.interaction_cutoff
+        near = (x - domain*self.domain_width + halo) % self.box[0] < self.domain_width + 2*halo
+        local = np.nonzero(owned | near)[0]
+
+        return np.nonzero(owned)[0], local, owned[local]
+
+    def domain_pairs(self, local):
+        # Neighbour pairs among the local agents, as indices into local
+        self.domain_cell_list.reference_position = None
+        return self.domain_cell_list.pairs(self.position[local])
+
+    def domain_forces(self, local, is_owned, pairs):
+        # Forces on the local agents that are owned, from all local agents that are not transparent
+        i, j, displacement, r = pairs
+        solid = ~self.transparent[local]
+        i, j, displacement, r = self.select_pairs(pairs, is_owned[i] & solid[i] & solid[j] & (r > 0))
+
+        magnitude = self.pair_force(r) / r
+        force = np.zeros((len(local), 2))
+        force[:, 0] = np.bincount(i, weights=magnitude*displacement[:, 0], minlength=len(local))
+        force[:, 1] = np.bincount(i, weights=magnitude*displacement[:, 1], minlength=len(local))
+
+        return force[is_owned]
+
+    def domain_infections(self, domain, local, is_owned, pairs):
+        # Owned susceptible agents infected by local infectious agents, decided with the generator of the domain
+        i, j, displacement, r = pairs
+        state = self.state[local]
+        infectious = (state == INCUBATING) | (state == SICK)
+        susceptible = (state == SUSCEPTIBLE) & is_owned
+
+        i, j, displacement, r = self.select_pairs(pairs, infectious[i] & susceptible[j])
+        if len(r) == 0:
+            return np.zeros(0, dtype=int)
+
+        probability = self.infection_probability(local[i], local[j], r)
+        random = np.random.default_rng(np.random.SeedSequence(self.domain_seed.entropy, spawn_key=self.domain_seed.spawn_key + (domain, int(self.clock[0]))))
+
+        return local[infection_draw(j, probability, len(local), random.random)]
+
+    def domain_step(self, domain):
+        # Phase 1: disease states. Agents are only written by the worker that owns them.
+        owned, local, is_owned = self.domain_agents(domain)
+        state, countdown = self.state[owned], self.countdown[owned]
+        sick, recovered, died = progress_states(state, countdown, self.will_recover[owned], self.agent_values('time_to_recover', owned), self.agent_values('time_to_die', owned))
+        self.state[owned], self.countdown[owned] = state, countdown
+
+        self.immobile[owned[died]] = True
+        self.transparent[owned[died]] = True
+        self.update_speeds(owned[np.concatenate((sick, recovered, died))])
+        self.domain_barrier.wait()
+
+        # Phase 2: infections and forces, read only
+        pairs = self.domain_pairs(local)
+        infected = self.domain_infections(domain, local, is_owned, pairs)
+        force = self.domain_forces(local, is_owned, pairs)
+        self.domain_barrier.wait()
+
+        # Phase 3: infections and the euler step of the owned agents
+        infect(self.state, self.countdown, self.time_to_incubate, infected)
+        self.update_speeds(infected)
+
+        immobile = self.immobile[owned]
+        mobile = owned[~immobile]
+        velocity = self.velocity[mobile] + (force[~immobile] / self.agent_values('mass', mobile)[:, None])*self.DT
+        self.velocity[mobile] = self.vectorized_energy_drift_compensation(velocity, self.energy_drift_compensation_slope, self.energy_drift_compensation_vmax, self.energy_drift_compensation_clipspeed)
+        self.velocity[owned[immobile]] = 0
+
+        self.position[owned] = (self.position[owned] + self.velocity[owned] * self.DT) % self.box
+
+    def step_profile_phases(self):
+        # The phases of a step run in the workers, only the step as a whole is timed
+        return []
+
+    def step(self):
+        if len(self.processes) == 0:
+            self.start_workers()
+
+        self.clock[0] = self.time
+        try:
+            self.step_barrier.wait()
+            self.step_barrier.wait()
+        except threading.BrokenBarrierError:
+            raise RuntimeError('A domain worker of ParallelSystem failed') from None
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self.close()
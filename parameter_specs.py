@@ -0,0 +1,147 @@
+import ast
+import functools
+import re
+import numpy as np
+
+# Distributions that can be used in a spec, with the names of the numpy random functions that sample them
+DISTRIBUTIONS = ('normal', 'uniform', 'lognormal', 'exponential', 'gamma', 'beta', 'poisson', 'binomial')
+
+# Agent parameters that may be given as a spec string
+SAMPLED_PARAMETERS = ('status', 'immobile', 'transparent', 'size', 'mass', 'healthy_velocity', 'incubation_velocity',
+                      'sickness_velocity', 'timeToRecover', 'timeToDie', 'timeToIncubate')
+PROFILE_PARAMETERS = ('disease_profile', 'infection_profile')
+
+
+class Spec:
+    # Base of the declarative parameter specs. A spec is a name with numeric arguments, like 'normal(80, 10)'. It only
+    # holds plain numbers, so it pickles cheaply, and str() gives back the spec string for JSON files.
+    def __init__(self, name, args=(), kwargs=None):
+        self.name = name
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+
+    def arguments(self):
+        return [repr(arg) for arg in self.args] + [key + '=' + repr(value) for key, value in self.kwargs.items()]
+
+    def __str__(self):
+        return self.name + '(' + ', '.join(self.arguments()) + ')'
+
+    def __repr__(self):
+        return type(self).__name__ + "('" + str(self) + "')"
+
+    def __eq__(self, other):
+        return type(self) is type(other) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash((type(self).__name__, str(self)))
+
+
+class Distribution(Spec):
+    # Distribution of an agent parameter, e.g. 'normal(80, 10) as int'. Calling it draws one value from the global
+    # generator, like the lambdas it replaces, sample draws the values of a whole population at once.
+    def __init__(self, name, args=(), kwargs=None, as_int=False):
+        if name not in DISTRIBUTIONS:
+            raise ValueError('Unknown distribution ' + repr(name) + ', expected one of ' + ', '.join(DISTRIBUTIONS))
+
+        super().__init__(name, args, kwargs)
+        self.as_int = as_int
+
+    def __str__(self):
+        return super().__str__() + (' as int' if self.as_int else '')
+
+    def sample(self, count, random=np.random):
+        values = getattr(random, self.name)(*self.args, size=count, **self.kwargs)
+        if self.as_int:
+            # Truncated towards zero, like int()
+            values = np.trunc(values).astype(int)
+
+        return values
+
+    def __call__(self):
+        return self.sample(1)[0].item()
+
+
+class Profile(Spec):
+    # Disease or infection profile: the probability of passing on or catching the disease at distance r. Works on
+    # single distances as well as on arrays of distances.
+    #   step(r0, p):   p closer than r0, 0 further away
+    #   linear(r0, p): from p at distance 0 down to 0 at r0
+    #   constant(p):   p at any distance
+    PROFILES = {'step': ('r0', 'p'), 'linear': ('r0', 'p'), 'constant': ('p',)}
+
+    def __init__(self, name, args=(), kwargs=None):
+        if name not in self.PROFILES:
+            raise ValueError('Unknown profile ' + repr(name) + ', expected one of ' + ', '.join(self.PROFILES))
+
+        parameters = dict(zip(self.PROFILES[name], args), **(kwargs or {}))
+        if set(parameters) != set(self.PROFILES[name]):
+            raise ValueError('Profile ' + name + ' takes the parameters ' + ', '.join(self.PROFILES[name]))
+
+        super().__init__(name, (), {key: parameters[key] for key in self.PROFILES[name]})
+
+    @property
+    def range(self):
+        # Distance beyond which the profile is 0
+        return self.kwargs.get('r0', np.inf)
+
+    def __call__(self, r):
+        r = np.asarray(r, dtype=float)
+        p = self.kwargs['p']
+
+        if self.name == 'step':
+            values = np.where(r < self.range, p, 0.0)
+        elif self.name == 'linear':
+            values = np.where(r < self.range, p*(1 - r/self.range), 0.0)
+        else:
+            values = np.full(r.shape, float(p))
+
+        return values if values.ndim > 0 else float(values)
+
+
+@functools.lru_cache(maxsize=None)
+def parse_spec(spec, profile=False):
+    # Parse a spec string into a Distribution or (with profile=True) a Profile. Only a function name with literal
+    # numbers as arguments is accepted, nothing is evaluated as Python.
+    match = re.fullmatch(r'\s*(.*?)(\s+as\s+int)?\s*', spec)
+    expression, as_int = match.group(1), match.group(2) is not None
+
+    try:
+        call = ast.parse(expression, mode='eval').body
+        if not isinstance(call, ast.Call) or not isinstance(call.func, ast.Name):
+            raise ValueError
+        args = [ast.literal_eval(arg) for arg in call.args]
+        kwargs = {keyword.arg: ast.literal_eval(keyword.value) for keyword in call.keywords}
+    except (SyntaxError, ValueError):
+        raise ValueError('Can not parse parameter spec ' + repr(spec) + ", expected e.g. 'normal(80, 10) as int' or 'step(r0=4, p=0.75)'")
+
+    if profile:
+        if as_int:
+            raise ValueError("Profile spec " + repr(spec) + " can not be used 'as int'")
+        return Profile(call.func.id, args, kwargs)
+
+    return Distribution(call.func.id, args, kwargs, as_int)
+
+
+def resolve_parameters(parameters):
+    # Agent parameters with all spec strings replaced by Distribution and Profile objects
+    resolved = dict(parameters)
+    for key in SAMPLED_PARAMETERS + PROFILE_PARAMETERS:
+        if isinstance(resolved.get(key), str):
+            resolved[key] = parse_spec(resolved[key], key in PROFILE_PARAMETERS)
+
+    return resolved
+
+
+def serialize_parameters(parameters):
+    # Agent parameters with Distribution and Profile objects written back as spec strings, ready for JSON
+    serialized = {}
+    for key, value in parameters.items():
+        if isinstance(value, Spec):
+            value = str(value)
+        elif isinstance(value, np.ndarray):
+            value = value.tolist()
+        elif callable(value):
+            raise ValueError('Agent parameter ' + repr(key) + ' is a Python callable and can not be serialized, use a spec string instead')
+        serialized[key] = value
+
+    return serialized
@@ -0,0 +1,118 @@
+import numpy as np
+from cell_list import CellList, minimum_image
+
+# Fraction of the plane covered by equal discs when random sequential placement jams, no more discs fit beyond it
+RANDOM_PACKING_LIMIT = 0.547
+
+
+def free_points(box, placed_position, placed_size, radius, spacing, random):
+    # Jittered lattice: one random point in every square of the given spacing, keeping the points where a disc of
+    # radius does not overlap a placed agent, in random order
+    cells = np.maximum(np.floor(box / spacing).astype(int), 1)
+    grid = np.stack(np.meshgrid(np.arange(cells[0]), np.arange(cells[1]), indexing='ij'), axis=-1).reshape(-1, 2)
+    points = (grid + random((len(grid), 2)))*(box / cells) % box
+
+    # Placed agents sorted into cells at least as wide as the largest distance at which they can block a point, so
+    # only the agents in the nine cells around a point are compared with it, one slot of every cell at a time
+    cutoff = (radius + placed_size.max(initial=0))*(1 + 1e-9) + 1e-12
+    agent_cells = np.maximum(np.floor(box / cutoff).astype(int), 1)
+    placed_cell = np.floor(placed_position / box * agent_cells).astype(int) % agent_cells
+    placed_id = placed_cell[:, 0]*agent_cells[1] + placed_cell[:, 1]
+    order = np.argsort(placed_id, kind='stable')
+    counts = np.bincount(placed_id, minlength=agent_cells[0]*agent_cells[1])
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    point_cell = np.floor(points / box * agent_cells).astype(int) % agent_cells
+    free = np.ones(len(points), dtype=bool)
+    offsets = np.unique(np.array([[dx, dy] for dx in (-1, 0, 1) for dy in (-1, 0, 1)]) % agent_cells, axis=0)
+    for offset in offsets:
+        neighbour = (point_cell + offset) % agent_cells
+        neighbour_id = neighbour[:, 0]*agent_cells[1] + neighbour[:, 1]
+        for slot in range(counts.max(initial=0)):
+            check = free & (slot < counts[neighbour_id])
+            agent = order[starts[neighbour_id[check]] + slot]
+            r = np.linalg.norm(minimum_image(points[check] - placed_position[agent], box), axis=1)
+            free[np.nonzero(check)[0][r <= radius + placed_size[agent]]] = False
+
+    points = points[free]
+
+    return points[np.argsort(random(len(points)))]
+
+
+def place_agents(box, size, existing_position=None, existing_size=None, max_rounds=100, random=np.random.random):
+    # Non-overlapping random positions for agents with the given sizes (radii), next to agents already in the box.
+    # All missing agents get a candidate position at once, and overlaps with placed agents and with each other are
+    # found with a cell list. Overlapping candidates are thrown again in the next round. Once less than half of the
+    # candidates of a round fit, uniform candidates mostly land on placed agents, and the next rounds throw them at the
+    # free points of a jittered lattice instead, which finds the remaining gaps up to close to RANDOM_PACKING_LIMIT.
+    # The agents are placed from the largest to the smallest, in classes of agents larger than half the largest one
+    # left, each with up to max_rounds rounds: small agents still fit in the gaps that large ones leave, but not the
+    # other way around. Raises a ValueError instead of retrying forever when the agents can not fit in the box.
+    box = np.asarray(box, dtype=float)
+    size = np.asarray(size, dtype=float)
+    placed_position = np.zeros((0, 2)) if existing_position is None else np.asarray(existing_position, dtype=float)
+    placed_size = np.zeros(0) if existing_size is None else np.asarray(existing_size, dtype=float)
+
+    position = np.zeros((len(size), 2))
+    if len(size) == 0:
+        return position
+
+    coverage = np.pi*(np.sum(size**2) + np.sum(placed_size**2)) / np.prod(box)
+    if coverage > RANDOM_PACKING_LIMIT:
+        raise ValueError('Can not place ' + str(len(size)) + ' agents: they would cover ' + str(round(100*coverage, 1)) +
+                         '% of the box, random placement can not exceed ' + str(100*RANDOM_PACKING_LIMIT) + '%')
+
+    cutoff = 2*max(size.max(), placed_size.max(initial=0))*(1 + 1e-9) + 1e-12
+    cells = np.maximum(np.floor(box / cutoff).astype(int), 1)
+    remaining = np.argsort(-size, kind='stable')
+    threshold = np.inf
+    rounds = 0
+    while rounds < max_rounds:
+        largest = size[remaining[0]]
+        if largest < threshold:
+            threshold = largest / 2
+            stalled = False
+            rounds = 0
+        batch = np.count_nonzero(size[remaining] >= threshold)
+        rounds += 1
+
+        if stalled:
+            # Lattice spacing of half the largest radius, with at most 16 points per agent
+            spacing = max(largest / 2, np.sqrt(np.prod(box) / (16*(len(size) + len(placed_size)))))
+            candidates = free_points(box, placed_position, placed_size, largest, spacing, random)[:batch]
+        else:
+            candidates = random((batch, 2))*box
+        waiting = remaining[len(candidates):]
+        remaining = remaining[:len(candidates)]
+
+        # Only placed agents in or next to a cell with a candidate can overlap with one
+        candidate_cells = np.zeros(cells, dtype=bool)
+        candidate_cells[tuple(np.floor(candidates / box * cells).astype(int).T % cells[:, None])] = True
+        nearby_cells = np.zeros(cells, dtype=bool)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                nearby_cells |= np.roll(candidate_cells, (dx, dy), axis=(0, 1))
+        nearby = nearby_cells[tuple(np.floor(placed_position / box * cells).astype(int).T % cells[:, None])]
+        number_placed = np.count_nonzero(nearby)
+
+        # Overlaps of candidates with nearby placed agents or with earlier candidates
+        combined_position = np.concatenate((placed_position[nearby], candidates))
+        combined_size = np.concatenate((placed_size[nearby], size[remaining]))
+        i, j, displacement, r = CellList(box, cutoff).pairs(combined_position)
+        overlap = (r <= combined_size[i] + combined_size[j]) & (i >= number_placed) & (j < i)
+
+        rejected = np.zeros(len(remaining), dtype=bool)
+        rejected[i[overlap] - number_placed] = True
+
+        position[remaining[~rejected]] = candidates[~rejected]
+        placed_position = np.concatenate((placed_position, candidates[~rejected]))
+        placed_size = np.concatenate((placed_size, size[remaining[~rejected]]))
+        stalled = stalled or np.count_nonzero(~rejected) < len(remaining) / 2
+        remaining = np.concatenate((remaining[rejected], waiting))
+        remaining = remaining[np.argsort(-size[remaining], kind='stable')]
+
+        if len(remaining) == 0:
+            return position
+
+    raise ValueError('Could not place ' + str(len(remaining)) + ' of ' + str(len(size)) + ' agents without overlap after ' +
+                     str(max_rounds) + ' rounds for agents of size ' + str(largest) + ', the box is too crowded (' + str(round(100*coverage, 1)) + '% covered)')
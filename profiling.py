@@ -0,0 +1,64 @@
+import json
+import time
+from collections import defaultdict
+
+
+class Profiler:
+    # Wall-clock time and number of calls per phase of a run, and counters of the work done. Phases are methods of the
+    # system that are replaced by timed versions with instrument, so nothing is timed (and nothing costs time) unless a
+    # system is profiled. Reports cover the steps since the previous report.
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.reports = []
+
+    def instrument(self, owner, name, phase=None, counters=None):
+        # Replace the method (or callable attribute) name of owner by a version that adds its duration to phase. With
+        # counters, counters(result, *args) gives a dictionary of counter increments for every call.
+        method = getattr(owner, name)
+        phase = phase or name
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            self.seconds[phase] += time.perf_counter() - start
+            self.calls[phase] += 1
+            if counters is not None:
+                for counter, count in counters(result, *args).items():
+                    self.counters[counter] += count
+            return result
+
+        setattr(owner, name, timed)
+
+    def report(self, step):
+        # Timers and counters since the previous report, which are then reset
+        report = {'time': step, 'seconds': dict(self.seconds), 'calls': dict(self.calls), 'counters': dict(self.counters)}
+        self.reports.append(report)
+        self.seconds.clear()
+        self.calls.clear()
+        self.counters.clear()
+
+        return report
+
+    def totals(self):
+        # Timers and counters summed over all reports
+        totals = {'seconds': defaultdict(float), 'calls': defaultdict(int), 'counters': defaultdict(int)}
+        for report in self.reports:
+            for key in totals:
+                for name, value in report[key].items():
+                    totals[key][name] += value
+
+        return {key: dict(values) for key, values in totals.items()}
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'totals': self.totals(), 'reports': self.reports}, file, indent=4)
+
+
+def print_report(system, report):
+    # Example hook: print where the time of the last steps went, as a share of the time spent in steps, measurements
+    # and rendering
+    total = sum(report['seconds'].get(phase, 0) for phase in ('step', 'measure', 'render'))
+    phases = ', '.join(phase + ' {:.1f}%'.format(100*seconds / total) for phase, seconds in sorted(report['seconds'].items()) if phase != 'step' and total > 0)
+    print('Step: ', report['time'], '{:.3f} s:'.format(total), phases, report['counters'])
@@ -0,0 +1,120 @@
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.collections import EllipseCollection
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import cv2
+
+
+def setup_axes(ax, box):
+    ax.grid(True)
+    ax.axis(xmin=-25, xmax=box[0] + 25, ymin=-25, ymax=box[1] + 25)
+    ax.set_aspect(1)
+
+
+def agent_collection(ax, positions, sizes, type_colors, status_colors):
+    agent_size = 2*sizes
+
+    return EllipseCollection(widths=agent_size,
+                             heights=agent_size,
+                             angles=0,
+                             units='xy',
+                             linewidths=2,
+                             transOffset=ax.transData,
+                             alpha=0.3,
+                             facecolors=type_colors,
+                             edgecolors=status_colors,
+                             offsets=positions)
+
+
+def plot_frame(export_path, positions, sizes, type_colors, status_colors, box, dpi=300):
+    # Draw one snapshot of the system and save it as an image
+    fig, ax = plt.subplots()
+    setup_axes(ax, box)
+    ax.add_collection(agent_collection(ax, positions, sizes, type_colors, status_colors))
+
+    fig.savefig(export_path, dpi=dpi)
+    plt.close(fig)
+
+
+class FigureRenderer:
+    # Keeps one matplotlib figure for the whole run. For every frame the agent collection is updated in place and
+    # drawn, and the pixels of the canvas are returned as a BGR image.
+    def __init__(self, box, dpi=300):
+        self.figure = Figure(dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.ax = self.figure.subplots()
+        setup_axes(self.ax, box)
+
+        self.points = None
+
+    def draw(self, positions, sizes, type_colors, status_colors):
+        if self.points is None:
+            self.points = agent_collection(self.ax, positions, sizes, type_colors, status_colors)
+            self.ax.add_collection(self.points)
+        else:
+            self.points.set_offsets(positions)
+            self.points.set_widths(2*sizes)
+            self.points.set_heights(2*sizes)
+            self.points.set_facecolor(type_colors)
+            self.points.set_edgecolor(status_colors)
+
+        self.canvas.draw()
+        return cv2.cvtColor(np.asarray(self.canvas.buffer_rgba()), cv2.COLOR_RGBA2BGR)
+
+
+class VideoStream:
+    # Writes frames straight into a video file, without saving images in between. The renderer (FigureRenderer or
+    # RasterRenderer) reuses its image for every frame, so memory use does not grow with the number of frames.
+    def __init__(self, video_path, fps, renderer):
+        self.video_path = video_path
+        self.fps = fps
+        self.renderer = renderer
+
+        self.writer = None
+        self.frames_written = 0
+
+    def write_frame(self, positions, sizes, type_colors, status_colors):
+        frame = self.renderer.draw(positions, sizes, type_colors, status_colors)
+
+        if self.writer is None:
+            height, width, layers = frame.shape
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+            self.writer = cv2.VideoWriter(self.video_path, fourcc, self.fps, (width, height))
+
+        self.writer.write(frame)
+        self.frames_written += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+
+class RenderPool:
+    # Renders frames in worker processes while the simulation continues. The simulation hands over small snapshots
+    # (positions, sizes and colors), at most max_pending frames are queued or being drawn at any time: submitting
+    # another one waits until the oldest frame is done, so memory stays bounded when rendering can not keep up.
+    def __init__(self, workers, max_pending=None):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending if max_pending is not None else 2*workers
+        self.pending = collections.deque()
+        self.frames_rendered = 0
+
+    def wait_for_oldest(self):
+        self.pending.popleft().result()
+        self.frames_rendered += 1
+
+    def submit(self, function, *args):
+        while len(self.pending) >= self.max_pending:
+            self.wait_for_oldest()
+
+        self.pending.append(self.executor.submit(function, *args))
+
+    def close(self):
+        while len(self.pending) > 0:
+            self.wait_for_oldest()
+
+        self.executor.shutdown()
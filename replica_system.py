@@ -0,0 +1,145 @@
+import numpy as np
+from cell_list import CellList, minimum_image
+from disease import NUMBER_OF_STATES, infection_draw
+from measurements import count_states
+from parameter_specs import resolve_parameters
+from vectorized_system import VectorizedSystem
+
+
+class ReplicaSystem(VectorizedSystem):
+    # VectorizedSystem that runs 'replicas' independent realizations of the same scenario at once. The agent arrays
+    # hold the agents of all replicas one replica after the other, so replica_view('position') is a (replicas, N, 2)
+    # view and replica_view('state') a (replicas, N) view, and every step advances all replicas with the same array
+    # operations. Pairs are only formed within a replica.
+    #
+    # Every replica draws its agents and infections from its own generator, seeded from 'replica_seeds' or spawned
+    # from 'seed'. Replica k runs exactly like a VectorizedSystem seeded with replica_seeds[k], as long as the agent
+    # parameters are numbers or distribution specs (callables are called in turn for all replicas) and there is no
+    # interaction_cutoff (with a cutoff the cell list is rebuilt when any replica needs it, which changes the order in
+    # which forces are summed, so replicas only agree to rounding).
+    #
+    # Measurements are kept per replica: system.measurements[k] has the {type: rows} form of System. Rendering and
+    # trajectories show replica 'render_replica' (default 0). With extinction_fast_forward, the run stops once all
+    # replicas are extinct. The adaptive integrator, energy diagnostics, the contact log, measurement streams and
+    # active sets are not supported.
+    def __init__(self, parameters):
+        super().__init__(parameters)
+
+        if self.integrator == 'adaptive' or self.energy_diagnostics:
+            raise ValueError('ReplicaSystem does not support the adaptive integrator or energy diagnostics')
+        if self.contact_log_file is not None or self.measurements_stream_file is not None:
+            raise ValueError('ReplicaSystem does not support a contact log or measurement stream')
+        if self.active_sets:
+            raise ValueError('ReplicaSystem does not support active sets')
+
+        self.replicas = parameters.get('replicas', 1)
+        seeds = parameters.get('replica_seeds', None)
+        if seeds is None:
+            seeds = self.random.bit_generator.seed_seq.spawn(self.replicas)
+        if len(seeds) != self.replicas:
+            raise ValueError('Expected ' + str(self.replicas) + ' replica seeds, got ' + str(len(seeds)))
+        self.replica_random = [np.random.default_rng(seed) for seed in seeds]
+
+        self.render_replica = parameters.get('render_replica', 0)
+        self.measurements = [{} for _ in range(self.replicas)]
+
+        if self.cell_list is not None:
+            self.cell_list = CellList(self.box, self.interaction_cutoff, self.neighbor_skin, self.replicas)
+
+    def __str__(self):
+        return "System contains " + str(self.replicas) + " replicas of " + str(self.replica_size) + " agents at time " + str(self.time)
+
+    @property
+    def replica_size(self):
+        return self.number_of_agents // self.replicas
+
+    def replica_view(self, name):
+        # Agent array name with the replicas as first axis
+        array = getattr(self, name)
+        return array.reshape((self.replicas, -1) + array.shape[1:])
+
+    def rendered_agents(self):
+        return slice(self.render_replica*self.replica_size, (self.render_replica + 1)*self.replica_size)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Handle System Plotting, Saving, Styling
+    # ------------------------------------------------------------------------------------------------------------------
+    def snapshot(self):
+        agents = self.rendered_agents()
+        types = [self.agent_types[type_id] for type_id in self.type_id[agents]]
+
+        return self.position[agents].copy(), self.size[agents].copy(), types, self.state[agents].copy()
+
+    def trajectory_frame(self):
+        agents = self.rendered_agents()
+        return list(self.agent_types), self.type_id[agents], self.position[agents], self.size[agents], self.state[agents], self.velocity[agents]
+
+    def state_counts(self):
+        # Agent types, and the number of agents of each type in each state as a (replicas, types, states) array
+        number_of_types = len(self.agent_types)
+        replica = np.repeat(np.arange(self.replicas), self.replica_size)
+        counts = count_states(replica*number_of_types + self.type_id, self.state, self.replicas*number_of_types)
+
+        return list(self.agent_types), counts.reshape(self.replicas, number_of_types, NUMBER_OF_STATES)
+
+    def record_counts(self, agent_types, counts, time):
+        for measurements, replica_counts in zip(self.measurements, counts):
+            for index, key in enumerate(agent_types):
+                measurements.setdefault(key, []).append(replica_counts[index].tolist() + [time])
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Handle Checkpoints
+    # ------------------------------------------------------------------------------------------------------------------
+    def checkpoint_state(self):
+        header, arrays = super().checkpoint_state()
+        header.update(replicas=self.replicas, replica_random=[random.bit_generator.state for random in self.replica_random])
+
+        return header, arrays
+
+    def restore_state(self, header, arrays):
+        if header['replicas'] != self.replicas:
+            raise ValueError('Checkpoint has ' + str(header['replicas']) + ' replicas, not ' + str(self.replicas))
+
+        super().restore_state(header, arrays)
+        for random, state in zip(self.replica_random, header['replica_random']):
+            random.bit_generator.state = state
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Handle System Simulation
+    # ------------------------------------------------------------------------------------------------------------------
+    def add_agents(self, parameters, count):
+        # Every replica gets count new agents after its current ones, drawn from its own generator
+        parameters = resolve_parameters(parameters)
+        new_agents = [self.new_agents(parameters, count, random, position, size)
+                      for random, position, size in zip(self.replica_random, self.replica_view('position'), self.replica_view('size'))]
+        fields = {name: np.concatenate([agents[name] for agents in new_agents]) for name in new_agents[0]}
+
+        for name, values in self.stored_fields(fields, self.sampled_parameters(parameters)).items():
+            current = self.replica_view(name)
+            combined = np.concatenate((current, values.reshape((self.replicas, count) + values.shape[1:])), axis=1)
+            setattr(self, name, combined.reshape((-1,) + combined.shape[2:]))
+
+    def neighbor_pairs(self):
+        # Without an interaction cutoff, all pairs within every replica, in the same order as VectorizedSystem
+        if self.cell_list is not None:
+            return super().neighbor_pairs()
+        if self.pair_cache is not None and self.pair_cache[0] is self.position:
+            return self.pair_cache[1]
+
+        i, j = np.nonzero(~np.eye(self.replica_size, dtype=bool))
+        first = (np.arange(self.replicas)*self.replica_size)[:, None]
+        i, j = (first + i).ravel(), (first + j).ravel()
+        displacement = minimum_image(self.position[i] - self.position[j], self.box)
+        pairs = i, j, displacement, np.linalg.norm(displacement, axis=1)
+
+        self.pair_cache = (self.position, pairs)
+        return pairs
+
+    def draw_infections(self, targets, probability):
+        # The exposed agents of every replica are decided with the generator of that replica
+        exposed = np.bincount(np.unique(targets) // self.replica_size, minlength=self.replicas)
+
+        def random(count):
+            return np.concatenate([np.zeros(0)] + [self.replica_random[replica].random(exposed[replica]) for replica in np.nonzero(exposed)[0]])
+
+        return infection_draw(targets, probability, self.number_of_agents, random)
@@ -1,13 +1,22 @@
+import os
+import time
 import numpy as np
-import random
 import json
 import codecs
-import matplotlib.pyplot as plt
-from matplotlib.collections import EllipseCollection
-import cv2
 import glob
 import re
-from agent import Agent
+from agent import Agent, Counter
+from checkpoint import write_checkpoint, read_checkpoint, random_states, restore_random_states, serialize_profile, deserialize_profile
+from measurements import MeasurementWriter, count_states
+from placement import place_agents
+from trajectory import TrajectoryWriter
+from force_kernel import ForceKernel
+from profiling import Profiler
+from contact_log import ContactLogWriter, infectious_ids
+
+# Rendering and video export (rendering.py, raster_rendering.py and with them matplotlib and cv2) and the live metrics
+# server (live_metrics.py and with it asyncio) are imported by the methods that use them, so a run that renders nothing
+# only loads NumPy.
 
 
 class System:
@@ -32,10 +41,20 @@ class System:
         self.time = 0
         self.agents = []
 
+        # Random number generator of the system, seeded with 'seed' for reproducible runs
+        self.random = np.random.default_rng(parameters.get('seed', None))
+        self.print_interval = parameters.get('print_interval', 10)
+
         # Measurements
         self.write_interval = parameters['write_interval']
         self.measurements = {}
 
+        # With measurements_stream_file set, measurements are not kept in memory but appended to that file every
+        # measurements_flush_interval measurements (see measurements.py), instead of written as JSON at the end
+        self.measurements_stream_file = parameters.get('measurements_stream_file', None)
+        self.measurements_flush_interval = parameters.get('measurements_flush_interval', 10)
+        self.measurement_writer = None
+
         # Color palette
         self.agent_type_colors = parameters['agent_type_colors']
         self.agent_status_colors = parameters['agent_status_colors']
@@ -49,9 +68,103 @@ class System:
         self.video_export_format = parameters['video_export_format']
         self.video_export_fps = parameters['video_export_fps']
 
+        # Rendering: every render_stride-th step is rendered (0 renders nothing), by render_workers background
+        # processes with at most render_queue_size frames waiting, or in the simulation process when render_workers is 0
+        self.render_stride = parameters.get('render_stride', 1)
+        self.render_workers = parameters.get('render_workers', 0)
+        self.render_queue_size = parameters.get('render_queue_size', None)
+        self.render_pool = None
+
+        # Frames are drawn with matplotlib, or with renderer 'raster' straight into an image of raster_width pixels wide
+        self.renderer = parameters.get('renderer', 'matplotlib')
+        self.raster_width = parameters.get('raster_width', 800)
+        self.raster_renderer = None
+
+        # With export_mode 'stream' the frames are written directly into the video instead of saved as images first
+        self.export_mode = parameters.get('export_mode', 'images')
+        self.video_stream = None
+
+        # Trajectory: with trajectory_file set, the positions, sizes, types, states and (with trajectory_velocities)
+        # velocities of every trajectory_stride-th step are stored in a memory-mapped file (see trajectory.py)
+        self.trajectory_file = parameters.get('trajectory_file', None)
+        self.trajectory_stride = parameters.get('trajectory_stride', 1)
+        self.trajectory_velocities = parameters.get('trajectory_velocities', False)
+        self.trajectory_writer = None
+
+        # Checkpoints: every checkpoint_interval steps (0 never) the full state is saved to checkpoint_file
+        self.checkpoint_file = parameters.get('checkpoint_file', None)
+        self.checkpoint_interval = parameters.get('checkpoint_interval', 0)
+
+        # Contact log: with contact_log_file set, every exposure of a susceptible agent to an infectious one is
+        # recorded in that file, in chunks of contact_log_chunk_size events (see contact_log.py)
+        self.contact_log_file = parameters.get('contact_log_file', None)
+        self.contact_log_chunk_size = parameters.get('contact_log_chunk_size', 65536)
+        self.contact_log = None
+
+        # Profiling: with profile, the time spent in every phase of a step and the work done are reported every
+        # profile_interval steps to profile_hook(system, report), and written next to the measurements file (or to
+        # profile_file). Without it nothing is timed.
+        self.profiler = Profiler() if parameters.get('profile', False) else None
+        self.profiler_started = False
+        self.profile_interval = parameters.get('profile_interval', self.write_interval)
+        self.profile_hook = parameters.get('profile_hook', None)
+        self.profile_file = parameters.get('profile_file', None)
+        measurements_file = self.measurements_stream_file or self.measurements_file
+        if self.profile_file is None and measurements_file is not None:
+            self.profile_file = os.path.splitext(measurements_file)[0] + '_profile.json'
+
+        # Active sets: with active_sets, a step only visits the agents each phase can affect. Infections are only
+        # checked from infectious to susceptible agents, and forces only act on agents that are not immobile and come
+        # from agents that are not transparent, so dead agents drop out of the pair loops.
+        self.active_sets = parameters.get('active_sets', False)
+
+        # Extinction: with extinction_fast_forward, the run stops once no agent is incubating or sick, as no state can
+        # change anymore, and the remaining measurements are filled with the final counts. With extinction_render_stride
+        # > 0 the agents keep moving instead, and only every extinction_render_stride-th step is rendered.
+        self.extinction_fast_forward = parameters.get('extinction_fast_forward', False)
+        self.extinction_render_stride = parameters.get('extinction_render_stride', 0)
+        self.extinction_time = None
+
+        # Live metrics: with live_metrics_port set (0 picks a free port), the state counts per type and the steps per
+        # second are published every live_metrics_interval steps, and the profile reports when profiling, by a server
+        # on live_metrics_host (see live_metrics.py). Publishing only appends to a queue of live_metrics_queue_size
+        # events that drops the oldest, so the run never waits for clients.
+        self.live_metrics_port = parameters.get('live_metrics_port', None)
+        self.live_metrics_host = parameters.get('live_metrics_host', '127.0.0.1')
+        self.live_metrics_interval = parameters.get('live_metrics_interval', self.write_interval)
+        self.live_metrics_queue_size = parameters.get('live_metrics_queue_size', 256)
+        self.live_metrics = None
+        self.live_metrics_clock = None
+
+        # Tabulated force: with force_table_size > 0 the force is interpolated from a table of that many entries up to
+        # force_cutoff (see force_kernel.py), by default the interaction cutoff or half the diagonal of the box, which
+        # is the largest distance between two agents. Below the distance where the table error exceeds
+        # force_core_tolerance, the force function is evaluated instead. The interpolation error is printed when the
+        # system is made, measured from force_error_min_distance (by default 0) to the cutoff.
+        self.force_table_size = parameters.get('force_table_size', 0)
+        self.force_cutoff = parameters.get('force_cutoff', parameters.get('interaction_cutoff', None))
+        if self.force_cutoff is None:
+            self.force_cutoff = np.linalg.norm(self.box) / 2
+        self.force_error_min_distance = parameters.get('force_error_min_distance', 0.0)
+        self.force_core_tolerance = parameters.get('force_core_tolerance', 1e-4)
+        self.force_kernel = None
+        if self.force_table_size > 0:
+            self.force_kernel = ForceKernel(self.force, self.force_constant, self.force_cutoff, self.force_table_size, self.force_error_min_distance, self.force_core_tolerance)
+            if self.print_interval > 0:
+                print(self.force_kernel.describe())
+
     def __str__(self):
         return "System contains " + str(len(self.agents)) + " agents at time " + str(self.time)
 
+    @staticmethod
+    def lookup_index(table, value):
+        for index, entry in enumerate(table):
+            if entry is value or entry == value:
+                return index
+
+        table.append(value)
+        return len(table) - 1
+
     # ------------------------------------------------------------------------------------------------------------------
     # Handle System Plotting, Saving, Styling
     # ------------------------------------------------------------------------------------------------------------------
@@ -68,73 +181,298 @@ class System:
 
         return status_array
 
-    def measure(self):
-        measurements = {}
+    def state_counts(self):
+        # Agent types, and the number of agents of each type in each state
+        agent_types, type_ids = np.unique([agent.type for agent in self.agents], return_inverse=True)
+        states = [agent.state for agent in self.agents]
 
-        for agent in self.agents:
-            if agent.type in measurements:
-                measurements[agent.type] = measurements[agent.type] + self.status_to_array(agent.state)
-            else:
-                measurements[agent.type] = self.status_to_array(agent.state)
+        return agent_types.tolist(), count_states(type_ids, states, len(agent_types))
 
-        for key in list(measurements.keys()):
-            measurements[key] = np.append(measurements[key], self.time)
+    def measure(self):
+        agent_types, counts = self.state_counts()
+        self.record_counts(agent_types, counts, self.time)
+
+    def record_counts(self, agent_types, counts, time):
+        if self.measurements_stream_file is not None:
+            if self.measurement_writer is None:
+                self.measurement_writer = MeasurementWriter(self.measurements_stream_file, agent_types, self.measurements_flush_interval)
+            self.measurement_writer.append(counts, time)
+            return
+
+        for index, key in enumerate(agent_types):
+            row = counts[index].tolist() + [time]
             if key in self.measurements:
-                self.measurements[key].append(measurements[key].tolist())
+                self.measurements[key].append(row)
             else:
-                self.measurements[key] = [measurements[key].tolist()]
+                self.measurements[key] = [row]
 
     def write(self):
+        if self.measurement_writer is not None:
+            self.measurement_writer.close()
+            self.measurement_writer = None
+            return
+
+        if self.measurements_file is None:
+            return
+
         json.dump(self.measurements, codecs.open(self.measurements_file, 'w', encoding='utf-8'), separators=(',', ':'), indent=4)
 
+    def write_profile(self):
+        if self.profiler is not None and self.profile_file is not None:
+            self.profiler.write(self.profile_file)
+
+    def snapshot(self):
+        # Positions, sizes, types and states of all agents, in the same order
+        positions = np.array([agent.position for agent in self.agents])
+        sizes = np.array([agent.size for agent in self.agents])
+        types = [agent.type for agent in self.agents]
+        states = np.array([agent.state for agent in self.agents])
+
+        return positions, sizes, types, states
+
+    def frame_colors(self, types, states):
+        agent_type_colors = [self.agent_type_color(agent_type) for agent_type in types]
+        agent_status_colors = [self.agent_status_color(state) for state in states]
+
+        return agent_type_colors, agent_status_colors
+
+    def frame_renderer(self):
+        # Renderer that draws frames into an image in memory, for streaming and raster rendering
+        if self.renderer == 'raster':
+            if self.raster_renderer is None:
+                from raster_rendering import RasterRenderer
+                self.raster_renderer = RasterRenderer(self.box, self.raster_width)
+            return self.raster_renderer
+
+        from rendering import FigureRenderer
+        return FigureRenderer(self.box)
+
     def save_plot(self, export_path):
-        agent_positions = [agent.position for agent in self.agents]
-        agent_size = [2*agent.size for agent in self.agents]
-        agent_type_colors = [self.agent_type_color(agent.type) for agent in self.agents]
-        agent_status_colors = [self.agent_status_color(agent.state) for agent in self.agents]
-
-        fig, ax = plt.subplots()
-        ax.grid(True)
-        ax.axis(xmin=-25, xmax=self.box[0] + 25, ymin=-25, ymax=self.box[1] + 25)
-        ax.set_aspect(1)
-
-        points = EllipseCollection(widths=agent_size,
-                                   heights=agent_size,
-                                   angles=0,
-                                   units='xy',
-                                   linewidths=2,
-                                   transOffset=ax.transData,
-                                   alpha=0.3,
-                                   facecolors=agent_type_colors,
-                                   edgecolors=agent_status_colors,
-                                   offsets=agent_positions)
-
-        ax.add_collection(points)
-
-        fig.savefig(export_path, dpi=300)
-        plt.close()
+        positions, sizes, types, states = self.snapshot()
+        agent_type_colors, agent_status_colors = self.frame_colors(types, states)
+
+        if self.renderer == 'raster':
+            import cv2
+            cv2.imwrite(export_path, self.frame_renderer().draw(positions, sizes, agent_type_colors, agent_status_colors))
+        else:
+            from rendering import plot_frame
+            plot_frame(export_path, positions, sizes, agent_type_colors, agent_status_colors, self.box)
+
+    def frame_path(self, step):
+        return self.export_path + self.image_export_name + str(step) + '.' + self.image_export_format
+
+    def frame_files(self):
+        # Frame images in export_path named like frame_path, ordered by step
+        pattern = re.escape(self.image_export_name) + r'(\d+)\.' + re.escape(self.image_export_format)
+        frames = []
+        for filename in glob.glob(self.export_path + self.image_export_name + '*.' + self.image_export_format):
+            match = re.fullmatch(pattern, os.path.basename(filename))
+            if match is not None:
+                frames.append((int(match.group(1)), filename))
+
+        return [filename for step, filename in sorted(frames)]
+
+    def clear_frames(self):
+        # Remove the frames of an earlier run, which would otherwise end up in the video of this one when they are
+        # at other steps (another render_stride or MAXSTEP)
+        for filename in self.frame_files():
+            os.remove(filename)
+
+    def render(self, step):
+        # Render every render_stride-th step, in the background when there is a render pool (raster frames are drawn
+        # in the simulation process, they are cheaper to draw than to send to another process)
+        if self.render_stride <= 0 or step % self.render_stride != 0:
+            return False
+
+        if self.video_stream is not None:
+            positions, sizes, types, states = self.snapshot()
+            agent_type_colors, agent_status_colors = self.frame_colors(types, states)
+            self.video_stream.write_frame(positions, sizes, agent_type_colors, agent_status_colors)
+        elif self.render_pool is None:
+            self.save_plot(self.frame_path(step))
+        else:
+            positions, sizes, types, states = self.snapshot()
+            agent_type_colors, agent_status_colors = self.frame_colors(types, states)
+            from rendering import plot_frame
+            self.render_pool.submit(plot_frame, self.frame_path(step), positions, sizes, agent_type_colors, agent_status_colors, self.box)
+
+        return True
+
+    def trajectory_frame(self):
+        # Agent types, and type ids, positions, sizes, states and velocities of all agents by agent id. step()
+        # shuffles self.agents, so the agents are sorted to keep row i the same agent in every frame.
+        agents = sorted(self.agents, key=lambda agent: agent.id)
+        agent_types, type_ids = np.unique([agent.type for agent in agents], return_inverse=True)
+        positions = np.array([agent.position for agent in agents])
+        sizes = np.array([agent.size for agent in agents])
+        states = np.array([agent.state for agent in agents])
+        velocities = np.array([np.zeros(2) + agent.velocity for agent in agents])
+
+        return agent_types.tolist(), type_ids, positions, sizes, states, velocities
+
+    def contact_log_agents(self):
+        # Agent types, the type id of every agent by agent id, and the ids of the infectious agents
+        agents = sorted(self.agents, key=lambda agent: agent.id)
+        agent_types, type_ids = np.unique([agent.type for agent in agents], return_inverse=True)
+
+        return agent_types.tolist(), type_ids, infectious_ids([agent.state for agent in agents])
+
+    def start_contact_log(self):
+        if self.contact_log_file is None or self.contact_log is not None:
+            return
+
+        agent_types, type_ids, infectious = self.contact_log_agents()
+        self.contact_log = ContactLogWriter(self.contact_log_file, agent_types, type_ids, infectious, self.contact_log_chunk_size)
+
+    def trajectory_capacity(self):
+        # Number of frames recorded in a run of MAXSTEP steps
+        return len(range(0, self.MAXSTEP, self.trajectory_stride))
+
+    def record_trajectory(self, step):
+        if self.trajectory_file is None or step % self.trajectory_stride != 0:
+            return
+
+        agent_types, type_ids, positions, sizes, states, velocities = self.trajectory_frame()
+        if self.trajectory_writer is None:
+            self.trajectory_writer = TrajectoryWriter(self.trajectory_file, len(states), self.trajectory_capacity(), agent_types, self.box, self.trajectory_stride, self.trajectory_velocities)
+
+        self.trajectory_writer.append(self.time, agent_types, type_ids, positions, sizes, states, velocities)
+
+    def video_path(self):
+        return self.export_path + self.video_export_name + '.' + self.video_export_format
 
     def create_animation_from_folder(self):
-        img_array = []
-        filenames = glob.glob(self.export_path + self.image_export_name + '*.' + self.image_export_format)
-        filenames.sort(key=lambda f: int(re.sub('\D', '', f)))
+        # A streamed run already wrote its video, which the images in export_path (of an earlier run) must not replace
+        if self.export_mode == 'stream':
+            return
 
-        if len(filenames) > 0:
-            for filename in filenames:
-                img = cv2.imread(filename)
-                img_array.append(img)
+        import cv2
+        filenames = self.frame_files()
 
-            height, width, layers = img_array[0].shape
+        if len(filenames) > 0:
+            # Images are read and written one at a time, so they never all have to be in memory
+            height, width, layers = cv2.imread(filenames[0]).shape
             video_size = (width, height)
 
             fourcc = cv2.VideoWriter_fourcc(*'mp4v')
 
-            out = cv2.VideoWriter(self.export_path + self.video_export_name + '.' + self.video_export_format, fourcc, self.video_export_fps, video_size)
+            out = cv2.VideoWriter(self.video_path(), fourcc, self.video_export_fps, video_size)
 
-            for i in range(len(img_array)):
-                out.write(img_array[i])
+            for filename in filenames:
+                out.write(cv2.imread(filename))
             out.release()
 
+    # ------------------------------------------------------------------------------------------------------------------
+    # Handle Checkpoints
+    # ------------------------------------------------------------------------------------------------------------------
+    def checkpoint_state(self):
+        # Header entries and arrays holding the state of all agents
+        agent_types, disease_profiles, infection_profiles = [], [], []
+        counters = [agent.counter for agent in self.agents]
+
+        arrays = {
+            'id': np.array([agent.id for agent in self.agents], dtype=int),
+            'position': np.array([agent.position for agent in self.agents], dtype=float).reshape(-1, 2),
+            'velocity': np.array([np.zeros(2) + agent.velocity for agent in self.agents], dtype=float).reshape(-1, 2),
+            'mass': np.array([agent.mass for agent in self.agents], dtype=float),
+            'size': np.array([agent.size for agent in self.agents], dtype=float),
+            'type_id': np.array([self.lookup_index(agent_types, agent.type) for agent in self.agents], dtype=int),
+            'state': np.array([agent.state for agent in self.agents], dtype=int),
+            'will_recover': np.array([agent.willRecover for agent in self.agents], dtype=bool),
+            'immobile': np.array([agent.immobile for agent in self.agents], dtype=bool),
+            'transparent': np.array([agent.transparent for agent in self.agents], dtype=bool),
+            'healthy_velocity': np.array([agent.healthy_velocity for agent in self.agents], dtype=float),
+            'incubation_velocity': np.array([agent.incubation_velocity for agent in self.agents], dtype=float),
+            'sickness_velocity': np.array([agent.sickness_velocity for agent in self.agents], dtype=float),
+            'time_to_incubate': np.array([agent.timeToIncubate for agent in self.agents], dtype=int),
+            'time_to_recover': np.array([agent.timeToRecover for agent in self.agents], dtype=int),
+            'time_to_die': np.array([agent.timeToDie for agent in self.agents], dtype=int),
+            'disease_profile_id': np.array([self.lookup_index(disease_profiles, agent.disease_profile) for agent in self.agents], dtype=int),
+            'infection_profile_id': np.array([self.lookup_index(infection_profiles, agent.infection_profile) for agent in self.agents], dtype=int),
+            'has_counter': np.array([counter is not None for counter in counters], dtype=bool),
+            'counter_tmax': np.array([counter.tmax if counter is not None else 0 for counter in counters], dtype=int),
+            'counter_time': np.array([counter.time if counter is not None else 0 for counter in counters], dtype=int),
+            'counter_expired': np.array([counter.expired if counter is not None else False for counter in counters], dtype=bool)
+        }
+
+        header = {'agent_types': agent_types,
+                  'disease_profiles': [serialize_profile(profile) for profile in disease_profiles],
+                  'infection_profiles': [serialize_profile(profile) for profile in infection_profiles]}
+
+        return header, arrays
+
+    def restore_state(self, header, arrays):
+        disease_profiles = [deserialize_profile(profile) for profile in header['disease_profiles']]
+        infection_profiles = [deserialize_profile(profile) for profile in header['infection_profiles']]
+
+        self.agents = []
+        for index in range(len(arrays['state'])):
+            agent = Agent.__new__(Agent)
+            agent.id = arrays['id'][index].item() if 'id' in arrays else index
+            agent.type = header['agent_types'][arrays['type_id'][index]]
+            agent.size = arrays['size'][index].item()
+            agent.mass = arrays['mass'][index].item()
+            agent.DT = self.DT
+            agent.willRecover = bool(arrays['will_recover'][index])
+            agent.box = self.box
+            agent.healthy_velocity = arrays['healthy_velocity'][index].item()
+            agent.incubation_velocity = arrays['incubation_velocity'][index].item()
+            agent.sickness_velocity = arrays['sickness_velocity'][index].item()
+            agent.disease_profile = disease_profiles[arrays['disease_profile_id'][index]]
+            agent.infection_profile = infection_profiles[arrays['infection_profile_id'][index]]
+            agent.timeToIncubate = arrays['time_to_incubate'][index].item()
+            agent.timeToRecover = arrays['time_to_recover'][index].item()
+            agent.timeToDie = arrays['time_to_die'][index].item()
+            agent.state = arrays['state'][index].item()
+            agent.immobile = bool(arrays['immobile'][index])
+            agent.transparent = bool(arrays['transparent'][index])
+            agent.position = np.array(arrays['position'][index])
+            agent.velocity = np.array(arrays['velocity'][index])
+
+            agent.counter = None
+            if arrays['has_counter'][index]:
+                agent.counter = Counter(arrays['counter_tmax'][index].item())
+                agent.counter.time = arrays['counter_time'][index].item()
+                agent.counter.expired = bool(arrays['counter_expired'][index])
+
+            self.agents.append(agent)
+
+    def save_checkpoint(self, path):
+        # Save the complete dynamic state: agents, time, measurements and random generators. Parameters, including
+        # the force and geometry functions, are not saved; load the checkpoint into a system made with the same
+        # (or deliberately changed) parameters.
+        header, arrays = self.checkpoint_state()
+        header.update(engine=type(self).__name__, time=self.time, measurements=self.measurements, random=random_states(self.random))
+
+        if self.measurement_writer is not None:
+            self.measurement_writer.flush()
+            header.update(measurement_types=self.measurement_writer.agent_types, measurement_rows=self.measurement_writer.rows_written)
+        if self.trajectory_writer is not None:
+            self.trajectory_writer.close()
+        if self.contact_log is not None:
+            header.update(contact_log_size=self.contact_log.size())
+
+        write_checkpoint(path, header, arrays)
+
+    def load_checkpoint(self, path):
+        header, arrays = read_checkpoint(path)
+        if header['engine'] != type(self).__name__:
+            raise ValueError(path + ' is a checkpoint of a ' + header['engine'] + ', not of a ' + type(self).__name__)
+
+        self.restore_state(header, arrays)
+        self.time = header['time']
+        self.measurements = header['measurements']
+        restore_random_states(self.random, header['random'])
+
+        if self.measurements_stream_file is not None and 'measurement_rows' in header:
+            self.measurement_writer = MeasurementWriter(self.measurements_stream_file, header['measurement_types'], self.measurements_flush_interval, resume_rows=header['measurement_rows'])
+
+        if self.trajectory_file is not None and os.path.exists(self.trajectory_file):
+            self.trajectory_writer = TrajectoryWriter(self.trajectory_file, None, self.trajectory_capacity(), None, None, resume_time=self.time)
+
+        if self.contact_log_file is not None and 'contact_log_size' in header:
+            self.contact_log = ContactLogWriter(self.contact_log_file, None, None, None, self.contact_log_chunk_size, resume_size=header['contact_log_size'])
+
     # ------------------------------------------------------------------------------------------------------------------
     # Handle System Simulation
     # ------------------------------------------------------------------------------------------------------------------
@@ -156,27 +494,102 @@ class System:
                     overlap = True
                     break
 
+        new_agent.id = len(self.agents)
         self.agents.append(new_agent)
 
+    def add_agents(self, parameters, count):
+        # Add count agents at once, placing them without overlap in one go instead of retrying one by one
+        new_agents = [Agent(parameters) for _ in range(count)]
+        positions = place_agents(self.box,
+                                 [agent.size for agent in new_agents],
+                                 [agent.position for agent in self.agents] if len(self.agents) > 0 else None,
+                                 [agent.size for agent in self.agents] if len(self.agents) > 0 else None,
+                                 random=self.random.random)
+
+        for agent, position in zip(new_agents, positions):
+            agent.set_position(position)
+            agent.id = len(self.agents)
+            self.agents.append(agent)
+
+    def pair_force(self, r):
+        # Magnitude of the force between two agents at distance r, from the force table if there is one
+        if self.force_kernel is not None:
+            return self.force_kernel(r)
+
+        return self.force(r, self.force_constant)
+
     def handle_force(self, agent_position, other_agent_position):
+        # One minimum image difference gives both the direction and the distance
         vec = self.vector_difference(other_agent_position, agent_position, self.box)
-        vec = vec / np.linalg.norm(vec)
+        r = np.linalg.norm(vec)
+
+        return self.pair_force(r) * vec / r
+
+    def handle_agent_state(self, agent):
+        # Progress the agent disease state, returns whether the state changed
+        state = agent.state
+        agent.handle_state()
+
+        return agent.state != state
+
+    def handle_infection(self, agent, other_agent):
+        # Possible infection of other_agent by agent, returns the number of infection attempts and infections
+        if other_agent.state == 0 and (agent.state == 1 or agent.state == 2):
+            r = self.norm(agent.position, other_agent.position, self.box)
+            probability = agent.disease_profile(r) * other_agent.infection_profile(r)
+            other_agent.get_infection(probability)
+
+            if self.contact_log is not None and probability > 0:
+                self.contact_log.append(self.time, agent.id, other_agent.id, r, other_agent.state != 0)
+            return 1, int(other_agent.state != 0)
 
-        r = self.norm(agent_position, other_agent_position, self.box)
+        return 0, 0
 
-        return self.force(r, self.force_constant) * vec
+    def shuffle_agents(self):
+        self.random.shuffle(self.agents)
+
+    def active_step(self):
+        # Step of the original engine restricted to the active sets, in the same order of agents. Agents only become
+        # infected, transparent or immobile during a step, so the sets taken at the start only shrink, and every agent
+        # in them is checked again when it is visited.
+        susceptible = [agent for agent in self.agents if agent.state == 0]
+        solid = [agent for agent in self.agents if not agent.transparent]
+
+        for agent in self.agents:
+            if agent.state == 1 or agent.state == 2:
+                self.handle_agent_state(agent)
+
+            if agent.state == 1 or agent.state == 2:
+                for other_agent in susceptible:
+                    if other_agent is not agent:
+                        self.handle_infection(agent, other_agent)
+
+            if agent.immobile:
+                continue
+
+            for other_agent in solid:
+                if other_agent is not agent and not other_agent.transparent:
+                    agent.add_force(self.handle_force(agent.position, other_agent.position))
+
+            agent.set_velocity(self.energy_drift_compensation(agent.velocity, self.energy_drift_compensation_slope, self.energy_drift_compensation_vmax, self.energy_drift_compensation_clipspeed))
+            agent.move()
+
+        self.apply_boundary_conditions()
+        self.shuffle_agents()
 
     def step(self):
+        if self.active_sets:
+            return self.active_step()
+
         for index, agent in enumerate(self.agents):
             # Progress the agent disease state
-            agent.handle_state()
+            self.handle_agent_state(agent)
 
             # Handle the forces applied to the agent by other agents, and check if other agent get infected
             for other_agent in [x for i, x in enumerate(self.agents) if i != index]:
 
                 # Handle possible infection of other agents from agent
-                if other_agent.state == 0 and (agent.state == 1 or agent.state == 2):
-                    other_agent.get_infection(agent.disease_profile(self.norm(agent.position, other_agent.position, self.box)) * other_agent.infection_profile(self.norm(agent.position, other_agent.position, self.box)))
+                self.handle_infection(agent, other_agent)
 
                 # Handle Forces applied on agent by other_agents
                 agent.add_force(self.handle_force(agent.position, other_agent.position))
@@ -186,21 +599,152 @@ class System:
             agent.move()
 
         self.apply_boundary_conditions()
-        random.shuffle(self.agents)
-
-    def run(self):
-        for i in range(self.MAXSTEP):
-            self.save_plot(self.export_path + self.image_export_name + str(i) + '.' + self.image_export_format)
+        self.shuffle_agents()
 
-            self.step()
-
-            if i % 10 == 0:
-                print('Step: ', i)
+    # ------------------------------------------------------------------------------------------------------------------
+    # Handle Profiling
+    # ------------------------------------------------------------------------------------------------------------------
+    def step_profile_phases(self):
+        # Methods of a step that are timed when profiling, as (method name, phase, counters), see profiling.py
+        return [('handle_agent_state', 'states', lambda changed, agent: {'transitions': int(changed)}),
+                ('handle_infection', 'infections', lambda result, agent, other_agent: {'infection_attempts': result[0], 'infections': result[1]}),
+                ('handle_force', 'forces', lambda force, agent_position, other_agent_position: {'pairs': 1}),
+                ('energy_drift_compensation', 'speed_limit', None),
+                ('apply_boundary_conditions', 'boundary_conditions', None),
+                ('shuffle_agents', 'shuffle', None)]
+
+    def start_profiling(self):
+        if self.profiler is None or self.profiler_started:
+            return
+
+        phases = [('step', 'step', None),
+                  ('measure', 'measure', None),
+                  ('render', 'render', lambda rendered, step: {'frames_rendered': int(rendered)})]
+        for name, phase, counters in phases + self.step_profile_phases():
+            self.profiler.instrument(self, name, phase, counters)
+        self.profiler_started = True
+
+    def profile_report(self):
+        report = self.profiler.report(self.time)
+        if self.live_metrics is not None:
+            self.live_metrics.publish('profile', report)
+        if self.profile_hook is not None:
+            self.profile_hook(self, report)
+
+    def extinct(self):
+        # Whether no agent is incubating or sick, after which no state can change anymore
+        agent_types, counts = self.state_counts()
+        return counts[..., 1].sum() + counts[..., 2].sum() == 0
+
+    def handle_extinction(self):
+        self.extinction_time = self.time
+        if self.print_interval > 0:
+            print('Extinct at step', self.time)
+
+        if self.extinction_render_stride > 0:
+            self.render_stride = self.extinction_render_stride
+            return
+
+        # The counts of the remaining measurements are the current ones
+        agent_types, counts = self.state_counts()
+        for time in range(self.time, self.MAXSTEP):
+            if time % self.write_interval == 0:
+                self.record_counts(agent_types, counts, time)
+        self.time = self.MAXSTEP
 
-            if i % self.write_interval == 0:
-                self.measure()
+    # ------------------------------------------------------------------------------------------------------------------
+    # Handle Live Metrics
+    # ------------------------------------------------------------------------------------------------------------------
+    def start_live_metrics(self):
+        if self.live_metrics_port is None:
+            return
+
+        from live_metrics import MetricsServer
+        self.live_metrics = MetricsServer(self.live_metrics_host, self.live_metrics_port, self.live_metrics_queue_size)
+        self.live_metrics.start()
+        self.live_metrics_clock = (self.time, time.perf_counter())
+        if self.print_interval > 0:
+            print('Live metrics: ', self.live_metrics.url())
+
+    def publish_metrics(self):
+        # State counts per type (per replica for a ReplicaSystem) and the steps per second since the last event
+        agent_types, counts = self.state_counts()
+        now = time.perf_counter()
+        steps, seconds = self.time - self.live_metrics_clock[0], now - self.live_metrics_clock[1]
+        self.live_metrics_clock = (self.time, now)
+
+        self.live_metrics.publish('metrics', {'time': self.time, 'steps_per_second': steps / seconds if seconds > 0 else None,
+                                              'counts': {key: counts[..., index, :].tolist() for index, key in enumerate(agent_types)}})
+
+    def stop_live_metrics(self):
+        if self.live_metrics is None:
+            return
+
+        self.live_metrics.publish('end', {'time': self.time, 'extinction_time': self.extinction_time})
+        self.live_metrics.close()
+        self.live_metrics = None
 
-            self.time = self.time + 1
+    def run(self):
+        self.start_profiling()
+        self.start_contact_log()
+        self.start_live_metrics()
+
+        # A new run (not one resumed from a checkpoint) starts without frames
+        if self.time == 0 and self.export_mode != 'stream' and self.render_stride > 0:
+            self.clear_frames()
+
+        if self.export_mode == 'stream' and self.render_stride > 0:
+            from rendering import VideoStream
+            self.video_stream = VideoStream(self.video_path(), self.video_export_fps, self.frame_renderer())
+        elif self.render_workers > 0 and self.render_stride > 0 and self.renderer != 'raster':
+            from rendering import RenderPool
+            self.render_pool = RenderPool(self.render_workers, self.render_queue_size)
+
+        try:
+            # Continues from the current time, so a run restored from a checkpoint resumes where it stopped
+            while self.time < self.MAXSTEP:
+                i = self.time
+                self.render(i)
+                self.record_trajectory(i)
+
+                self.step()
+
+                if self.print_interval > 0 and i % self.print_interval == 0:
+                    print('Step: ', i)
+
+                if i % self.write_interval == 0:
+                    self.measure()
+
+                self.time = self.time + 1
+
+                if self.checkpoint_file is not None and self.checkpoint_interval > 0 and self.time % self.checkpoint_interval == 0:
+                    self.save_checkpoint(self.checkpoint_file)
+
+                if self.profiler is not None and self.time % self.profile_interval == 0:
+                    self.profile_report()
+
+                if self.extinction_fast_forward and self.extinction_time is None and self.extinct():
+                    self.handle_extinction()
+
+                if self.live_metrics is not None and (self.time % self.live_metrics_interval == 0 or self.time == self.MAXSTEP):
+                    self.publish_metrics()
+        finally:
+            if self.render_pool is not None:
+                self.render_pool.close()
+                self.render_pool = None
+            if self.video_stream is not None:
+                self.video_stream.close()
+                self.video_stream = None
+            if self.trajectory_writer is not None:
+                self.trajectory_writer.close()
+                self.trajectory_writer = None
+            if self.contact_log is not None:
+                self.contact_log.close()
+                self.contact_log = None
+            self.stop_live_metrics()
+
+        if self.profiler is not None and len(self.profiler.calls) > 0:
+            self.profile_report()
 
         self.write()
-
+        self.write_profile()
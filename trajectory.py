@@ -0,0 +1,196 @@
+import json
+import os
+import numpy as np
+
+# Trajectory file layout: MAGIC, the number of frames written as uint64, the header length as uint64, a JSON header,
+# then one preallocated array per field, each starting at a multiple of ALIGNMENT bytes and holding capacity frames.
+# The frame count is updated after every frame, so a trajectory can be read while it is being written.
+MAGIC = b'MDVSTRAJ'
+ALIGNMENT = 64
+COUNT_OFFSET = len(MAGIC)
+
+
+def frame_fields(number_of_agents, velocities, precision):
+    fields = {'time': (np.int64, ()),
+              'position': (precision, (number_of_agents, 2)),
+              'size': (precision, (number_of_agents,)),
+              'type_id': (np.int16, (number_of_agents,)),
+              'state': (np.int8, (number_of_agents,))}
+    if velocities:
+        fields['velocity'] = (precision, (number_of_agents, 2))
+
+    return fields
+
+
+def open_arrays(path, header, data_start, mode):
+    return {name: np.memmap(path, dtype=np.dtype(layout['dtype']), mode=mode, offset=data_start + layout['offset'],
+                            shape=(header['capacity'],) + tuple(layout['shape']))
+            for name, layout in header['arrays'].items()}
+
+
+def read_header(path):
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a trajectory file')
+        frames, header_length = np.frombuffer(file.read(16), dtype=np.uint64)
+        header = json.loads(file.read(int(header_length)).decode('utf-8'))
+
+    return header, -(-(len(MAGIC) + 16 + int(header_length)) // ALIGNMENT)*ALIGNMENT
+
+
+class TrajectoryWriter:
+    # Appends the positions, sizes, type ids, states and optionally velocities of all agents to a memory-mapped file
+    # that is preallocated for capacity frames. With resume_time, an existing trajectory is continued from the first
+    # frame at or after that time (when resuming a checkpoint), and grown to capacity frames if it is smaller.
+    def __init__(self, path, number_of_agents, capacity, agent_types, box, stride=1, velocities=False, precision=np.float32, resume_time=None):
+        self.path = path
+
+        if resume_time is not None:
+            header, data_start = read_header(path)
+            if capacity is not None and capacity > header['capacity']:
+                self.grow(header, capacity)
+                header, data_start = read_header(path)
+
+            self.agent_types = header['agent_types']
+            self.arrays = open_arrays(path, header, data_start, 'r+')
+            self.count = np.memmap(path, dtype=np.uint64, mode='r+', offset=COUNT_OFFSET, shape=(1,))
+            self.frames = int(np.searchsorted(self.arrays['time'][:int(self.count[0])], resume_time))
+            self.count[0] = self.frames
+            return
+
+        self.agent_types = list(agent_types)
+        layout = {}
+        offset = 0
+        for name, (dtype, shape) in frame_fields(number_of_agents, velocities, precision).items():
+            dtype = np.dtype(dtype)
+            layout[name] = {'dtype': dtype.str, 'shape': list(shape), 'offset': offset}
+            offset += -(-capacity*dtype.itemsize*int(np.prod(shape)) // ALIGNMENT)*ALIGNMENT
+
+        header = {'number_of_agents': number_of_agents, 'capacity': capacity, 'agent_types': self.agent_types,
+                  'box': np.asarray(box).tolist(), 'stride': stride, 'arrays': layout}
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = -(-(len(MAGIC) + 16 + len(header_bytes)) // ALIGNMENT)*ALIGNMENT
+
+        with open(path, 'wb') as file:
+            file.write(MAGIC + np.array([0, len(header_bytes)], dtype=np.uint64).tobytes() + header_bytes)
+            file.truncate(data_start + offset)
+
+        self.arrays = open_arrays(path, header, data_start, 'r+')
+        self.count = np.memmap(path, dtype=np.uint64, mode='r+', offset=COUNT_OFFSET, shape=(1,))
+        self.frames = 0
+
+    def grow(self, header, capacity):
+        # Copy the trajectory into a new file with room for capacity frames, then replace the old file with it
+        reader = TrajectoryReader(self.path)
+        layout = header['arrays']
+        writer = TrajectoryWriter(self.path + '.tmp', header['number_of_agents'], capacity, header['agent_types'], header['box'],
+                                  header['stride'], 'velocity' in layout, np.dtype(layout['position']['dtype']))
+        for name, array in writer.arrays.items():
+            array[:len(reader)] = reader.arrays[name][:len(reader)]
+        writer.count[0] = len(reader)
+        writer.close()
+        del reader, writer
+
+        os.replace(self.path + '.tmp', self.path)
+
+    def type_ids(self, agent_types):
+        # Map the type ids of a system onto the type ids of this trajectory
+        for agent_type in agent_types:
+            if agent_type not in self.agent_types:
+                raise ValueError('Agent type ' + repr(agent_type) + ' was not in the system when the trajectory was started')
+
+        return np.array([self.agent_types.index(agent_type) for agent_type in agent_types], dtype=int)
+
+    def append(self, time, agent_types, type_ids, positions, sizes, states, velocities=None):
+        if self.frames == len(self.arrays['time']):
+            raise ValueError('Trajectory ' + self.path + ' is full (' + str(self.frames) + ' frames)')
+
+        frame = self.frames
+        self.arrays['time'][frame] = time
+        self.arrays['position'][frame] = positions
+        self.arrays['size'][frame] = sizes
+        self.arrays['type_id'][frame] = self.type_ids(agent_types)[type_ids]
+        self.arrays['state'][frame] = states
+        if 'velocity' in self.arrays and velocities is not None:
+            self.arrays['velocity'][frame] = velocities
+
+        self.frames += 1
+        self.count[0] = self.frames
+
+    def close(self):
+        for array in self.arrays.values():
+            array.flush()
+        self.count.flush()
+
+
+class TrajectoryReader:
+    # Read-only view of a trajectory file. Fields are memory maps, so frames are only read from disk when used:
+    # reader.position[100], reader.state[::10] or reader[5:50:5] do not load the rest of the trajectory. Several
+    # processes can read the same trajectory at the same time.
+    def __init__(self, path):
+        self.path = path
+        header, data_start = read_header(path)
+
+        self.number_of_agents = header['number_of_agents']
+        self.capacity = header['capacity']
+        self.agent_types = header['agent_types']
+        self.box = np.array(header['box'])
+        self.stride = header['stride']
+        self.arrays = open_arrays(path, header, data_start, 'r')
+        self.count = np.memmap(path, dtype=np.uint64, mode='r', offset=COUNT_OFFSET, shape=(1,))
+
+    def __len__(self):
+        # Frames written so far
+        return int(self.count[0])
+
+    def __getattr__(self, name):
+        # time, position, size, type_id, state and (if recorded) velocity of all frames written so far
+        if name != 'arrays' and name in self.arrays:
+            return self.arrays[name][:len(self)]
+        raise AttributeError(name)
+
+    def __getitem__(self, frames):
+        # Fields of one frame or a (strided) slice of frames, as a dictionary
+        return {name: array[:len(self)][frames] for name, array in self.arrays.items()}
+
+    def snapshot(self, frame):
+        # Positions, sizes, types and states of one frame, like System.snapshot
+        types = [self.agent_types[type_id] for type_id in self.arrays['type_id'][frame]]
+        return np.array(self.arrays['position'][frame]), np.array(self.arrays['size'][frame]), types, np.array(self.arrays['state'][frame])
+
+
+def render_trajectory_frame(path, frame, export_path, agent_type_colors, agent_status_colors, renderer='raster', raster_width=800):
+    # Render one frame of a trajectory file to an image; opens the file itself, so it can run in a worker process
+    reader = TrajectoryReader(path)
+    positions, sizes, types, states = reader.snapshot(frame)
+    type_colors = [agent_type_colors[agent_type] for agent_type in types]
+    status_colors = [agent_status_colors[state] for state in states]
+
+    if renderer == 'raster':
+        import cv2
+        from raster_rendering import RasterRenderer
+        cv2.imwrite(export_path, RasterRenderer(reader.box, raster_width).draw(positions, sizes, type_colors, status_colors))
+    else:
+        from rendering import plot_frame
+        plot_frame(export_path, positions, sizes, type_colors, status_colors, reader.box)
+
+
+def render_trajectory(path, export_path, agent_type_colors, agent_status_colors, frames=slice(None), image_export_format='png', workers=0, renderer='raster'):
+    # Render (a strided slice of) the frames of a trajectory after the run, named by their time like System.run does,
+    # on a pool of worker processes when workers > 0
+    reader = TrajectoryReader(path)
+    jobs = [(path, frame, export_path + str(reader.time[frame]) + '.' + image_export_format, agent_type_colors, agent_status_colors, renderer)
+            for frame in range(len(reader))[frames]]
+
+    if workers == 0:
+        for job in jobs:
+            render_trajectory_frame(*job)
+        return
+
+    from rendering import RenderPool
+    pool = RenderPool(workers)
+    try:
+        for job in jobs:
+            pool.submit(render_trajectory_frame, *job)
+    finally:
+        pool.close()
@@ -0,0 +1,611 @@
+import time
+import json
+import codecs
+import numpy as np
+from cell_list import CellList, minimum_image
+from checkpoint import serialize_profile, deserialize_profile
+from measurements import count_states
+from parameter_specs import Distribution, Profile, resolve_parameters
+from placement import place_agents
+from force_kernel import ForceKernel
+from contact_log import attribute_infections, infectious_ids
+from integrators import INTEGRATORS
+from disease import SUSCEPTIBLE, INCUBATING, SICK, progress_states, infection_draw, infect, state_speed
+from agent_view import AgentViews
+from system import System
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Array versions of the functions used in corona_simulation.py
+# ----------------------------------------------------------------------------------------------------------------------
+def energy_drift_compensation(velocity, s=0.25, vmax=1, clipspeed=1000):
+    # Row-wise version of the sigmoid speed limit in corona_simulation.py for an (N, 2) velocity array
+    speed = np.linalg.norm(velocity, axis=1)
+    moving = speed > 0
+
+    scale = np.zeros_like(speed)
+    clipped = np.minimum(speed[moving], clipspeed)
+    scale[moving] = vmax*(1/(1+np.exp(-s*clipped)) - 1/2) / speed[moving]
+
+    return velocity * scale[:, None]
+
+
+def evaluate_profile(profile, r):
+    # Evaluate a disease or infection profile on an array of distances. Profiles written for scalars
+    # (e.g. with an 'if r < r0' branch) are evaluated element-wise instead.
+    if not callable(profile):
+        return np.full(r.shape, float(profile))
+
+    try:
+        values = np.asarray(profile(r), dtype=float)
+        if values.shape == r.shape:
+            return values
+    except (ValueError, TypeError):
+        pass
+
+    return np.vectorize(profile, otypes=[float])(r)
+
+
+def profile_range(profile):
+    # Distance beyond which a disease or infection profile is 0, or None for a function whose range is not known
+    if isinstance(profile, Profile):
+        return profile.range
+    if not callable(profile):
+        return np.inf if float(profile) != 0 else 0.0
+
+    return None
+
+
+def compact(values, dtype):
+    # Copy of values as an array of dtype, refusing integers that do not fit in dtype instead of wrapping them around
+    values = np.asarray(values)
+    if np.issubdtype(dtype, np.integer) and np.issubdtype(values.dtype, np.integer) and values.size > 0:
+        limits = np.iinfo(dtype)
+        if values.min() < limits.min or values.max() > limits.max:
+            raise ValueError('Values from ' + str(values.min()) + ' to ' + str(values.max()) + ' do not fit in ' + np.dtype(dtype).name)
+
+    return values.astype(dtype)
+
+
+def group_parameter(name):
+    # Agent array of a group parameter: the agents' own values if they have them, otherwise the value of their group
+    def get(system):
+        if name in system.agent_parameters:
+            return system.agent_parameters[name]
+        return system.group_table[name][system.group_id]
+
+    def set(system, values):
+        system.agent_parameters[name] = values
+
+    return property(get, set)
+
+
+class VectorizedSystem(System):
+    # Alternative to System that stores the agents as a struct of arrays instead of a list of Agent
+    # objects, and advances all of them at once with NumPy array operations. It takes the same system and agent
+    # parameter dictionaries and writes measurements of the same format.
+    #
+    # The results are not statistically identical to System at DT = 1. System updates the agents one after the
+    # other, each seeing the agents before it already moved and infected in the same step. Here all agents are
+    # updated at once from the start of the step, so agents come closer before the repulsion acts and epidemics
+    # spread faster (see the README). The difference shrinks with DT.
+    #
+    # The geometry is fixed to the periodic box with minimum image convention (as in corona_simulation.py), since
+    # the scalar norm, vector_difference, boundary_condition and energy_drift_compensation callables can not be
+    # applied to whole arrays. A vectorized speed limit can be given as 'vectorized_energy_drift_compensation'.
+    #
+    # With 'interaction_cutoff' set, forces and infections are only evaluated for pairs closer than the cutoff, found
+    # with a cell list, so that a step scales with N instead of N^2. The cutoff must be at least the range of the
+    # disease and infection profiles, which is checked when agents are added (see check_interaction_cutoff).
+    #
+    # The 'integrator' parameter selects how positions and velocities are advanced (see integrators.py); only 'euler'
+    # uses the speed limit.
+    #
+    # Agent arrays are stored compactly: positions, velocities and the other real parameters in 'precision' (float64
+    # or float32), states and type codes in int8, and countdowns and disease times in 'countdown_precision' (int32 or
+    # int16). Parameters given as a number are stored once per group of agents added with the same parameters, in
+    # group_table, and only parameters drawn from a distribution or callable get an array entry per agent. The agents
+    # can still be read and changed one at a time as system.agents[i] (see agent_view.py).
+    def __init__(self, parameters):
+        super().__init__(parameters)
+
+        self.box = np.asarray(self.box, dtype=float)
+        self.vectorized_energy_drift_compensation = parameters.get('vectorized_energy_drift_compensation', energy_drift_compensation)
+
+        # Neighbour search, pairs further apart than the cutoff are skipped for both forces and infections
+        self.interaction_cutoff = parameters.get('interaction_cutoff', None)
+        self.neighbor_skin = parameters.get('neighbor_skin', 1)
+        self.cell_list = None
+        if self.interaction_cutoff is not None:
+            self.cell_list = CellList(self.box, self.interaction_cutoff, self.neighbor_skin)
+
+        # Generator deciding which exposure caused an infection for the contact log, separate from the system generator
+        # so that logging contacts does not change the run
+        self.contact_random = np.random.default_rng(self.random.bit_generator.seed_seq.spawn(1)[0])
+
+        # Pairs and forces at the current positions, reused until the agents move
+        self.pair_cache = None
+        self.force_cache = None
+
+        # Agents in the neighbour search with active_sets, the cell list is rebuilt when they change
+        self.active_agents = None
+
+        # Integrator, with the settings of the adaptive integrator. With everyone healthy and DT = 1, the total energy
+        # drifts by about 0.1% over 400 steps with adaptive_accuracy 0.02, but by 28% with 0.1.
+        if parameters.get('integrator', 'euler') not in INTEGRATORS:
+            raise ValueError('Unknown integrator ' + repr(parameters['integrator']) + ', expected one of ' + ', '.join(INTEGRATORS))
+        self.integrator = parameters.get('integrator', 'euler')
+        self.adaptive_accuracy = parameters.get('adaptive_accuracy', 0.02)
+        self.max_substeps = parameters.get('max_substeps', 100)
+
+        # With energy_diagnostics, the kinetic and potential energy, temperature, largest force, smallest distance,
+        # number of substeps and duration of every step are kept in diagnostics, and written to diagnostics_file.
+        # The potential energy is integrated from the (tabulated) force.
+        self.energy_diagnostics = parameters.get('energy_diagnostics', False)
+        self.diagnostics_file = parameters.get('diagnostics_file', None)
+        self.diagnostics = {key: [] for key in ('time', 'substeps', 'seconds', 'kinetic_energy', 'potential_energy', 'total_energy', 'temperature', 'max_force', 'min_distance')}
+        self.potential_kernel = self.force_kernel
+        if self.energy_diagnostics and self.potential_kernel is None:
+            self.potential_kernel = ForceKernel(self.force, self.force_constant, self.force_cutoff)
+
+        # Lookup tables shared by all agents, agents refer to these by index
+        self.agent_types = []
+        self.disease_profiles = []
+        self.infection_profiles = []
+
+        # Types of the agent arrays
+        self.precision = np.dtype(parameters.get('precision', 'float64'))
+        self.countdown_precision = np.dtype(parameters.get('countdown_precision', 'int32'))
+        self.agent_dtypes = {'position': self.precision, 'velocity': self.precision, 'state': np.int8,
+                             'countdown': self.countdown_precision, 'will_recover': bool, 'immobile': bool,
+                             'transparent': bool, 'group_id': np.int16, 'type_id': np.int8, 'mass': self.precision,
+                             'size': self.precision, 'healthy_velocity': self.precision,
+                             'incubation_velocity': self.precision, 'sickness_velocity': self.precision,
+                             'time_to_incubate': self.countdown_precision, 'time_to_recover': self.countdown_precision,
+                             'time_to_die': self.countdown_precision, 'disease_profile_id': np.int16,
+                             'infection_profile_id': np.int16}
+
+        # Agent arrays, the values of the group parameters per group, and the group parameters agents have their own
+        # values of
+        self.position = np.zeros((0, 2), dtype=self.precision)
+        self.velocity = np.zeros((0, 2), dtype=self.precision)
+        for name in ('state', 'countdown', 'will_recover', 'immobile', 'transparent', 'group_id'):
+            setattr(self, name, np.zeros(0, dtype=self.agent_dtypes[name]))
+        self.group_table = {name: np.zeros(0, dtype=self.agent_dtypes[name]) for name in self.group_parameters}
+        self.agent_parameters = {}
+
+    def __str__(self):
+        return "System contains " + str(self.number_of_agents) + " agents at time " + str(self.time)
+
+    @property
+    def number_of_agents(self):
+        return len(self.state)
+
+    # Arrays every agent has its own entry in
+    agent_columns = ('position', 'velocity', 'state', 'countdown', 'will_recover', 'immobile', 'transparent', 'group_id')
+
+    # Group parameters, stored per group of agents in group_table and looked up with group_id, and the agent
+    # parameters that the numeric ones are drawn from
+    group_parameters = ('type_id', 'mass', 'size', 'healthy_velocity', 'incubation_velocity', 'sickness_velocity',
+                        'time_to_incubate', 'time_to_recover', 'time_to_die', 'disease_profile_id', 'infection_profile_id')
+    drawn_parameters = {'mass': 'mass', 'size': 'size', 'healthy_velocity': 'healthy_velocity',
+                        'incubation_velocity': 'incubation_velocity', 'sickness_velocity': 'sickness_velocity',
+                        'time_to_incubate': 'timeToIncubate', 'time_to_recover': 'timeToRecover', 'time_to_die': 'timeToDie'}
+
+    type_id = group_parameter('type_id')
+    mass = group_parameter('mass')
+    size = group_parameter('size')
+    healthy_velocity = group_parameter('healthy_velocity')
+    incubation_velocity = group_parameter('incubation_velocity')
+    sickness_velocity = group_parameter('sickness_velocity')
+    time_to_incubate = group_parameter('time_to_incubate')
+    time_to_recover = group_parameter('time_to_recover')
+    time_to_die = group_parameter('time_to_die')
+    disease_profile_id = group_parameter('disease_profile_id')
+    infection_profile_id = group_parameter('infection_profile_id')
+
+    @property
+    def agent_arrays(self):
+        # Names of the arrays with an entry per agent
+        return self.agent_columns + tuple(self.agent_parameters)
+
+    @property
+    def agents(self):
+        return AgentViews(self)
+
+    @agents.setter
+    def agents(self, agents):
+        # System starts with an empty list of agents, here the agents live in the agent arrays
+        if len(agents) > 0:
+            raise ValueError('The agents of a VectorizedSystem are added with add_agents')
+
+    def agent_values(self, name, agents):
+        # Values of agent array name for the given agents only
+        if name in self.group_parameters and name not in self.agent_parameters:
+            return self.group_table[name][self.group_id[agents]]
+
+        return getattr(self, name)[agents]
+
+    def set_agent_values(self, name, agents, values):
+        # Change agent array name for the given agents only, giving them their own values of a group parameter
+        if name in self.group_parameters and name not in self.agent_parameters:
+            self.agent_parameters[name] = self.group_table[name][self.group_id]
+
+        getattr(self, name)[agents] = values
+
+        # The cached pairs and forces are kept while the position array is the same object, which a change in place
+        # does not replace
+        if name in ('position', 'size', 'state', 'transparent'):
+            self.invalidate_caches()
+
+    def invalidate_caches(self):
+        # Forget the pairs and forces at the current positions, and rebuild the cell list at the next neighbour search
+        self.pair_cache = None
+        self.force_cache = None
+        if self.cell_list is not None:
+            self.cell_list.reference_position = None
+
+    def bytes_per_agent(self):
+        # Memory of the agent arrays per agent, the group table and the other lookup tables do not grow with the agents
+        return sum(getattr(self, name).nbytes for name in self.agent_arrays) / max(self.number_of_agents, 1)
+
+    def sampled_parameters(self, parameters):
+        # Group parameters drawn from a distribution or callable, which every agent needs its own values of
+        return [name for name, key in self.drawn_parameters.items() if callable(parameters[key])]
+
+    def stored_fields(self, fields, sampled=()):
+        # Arrays to store for new agents, given all their agent arrays: their entries of the agent columns and of the
+        # parameters they have their own values of, and the group of agents with the same other parameters, which is
+        # added to group_table if it is new. A parameter that becomes sampled is taken out of the table for the
+        # agents already there.
+        count = len(fields['state'])
+        for name in sampled:
+            if name not in self.agent_parameters:
+                self.agent_parameters[name] = self.group_table[name][self.group_id]
+
+        stored = {name: compact(fields[name], self.agent_dtypes[name]) for name in self.agent_columns if name != 'group_id'}
+        stored.update({name: compact(fields[name], self.agent_dtypes[name]) for name in self.agent_parameters})
+        if count == 0:
+            stored['group_id'] = np.zeros(0, dtype=self.agent_dtypes['group_id'])
+            return stored
+
+        values = {name: compact(fields[name][:1], self.agent_dtypes[name]) for name in self.group_parameters}
+        same = np.ones(len(self.group_table['type_id']), dtype=bool)
+        for name in self.group_parameters:
+            if name not in self.agent_parameters:
+                same &= self.group_table[name] == values[name]
+
+        if same.any():
+            group = np.argmax(same)
+        else:
+            group = len(same)
+            for name in self.group_parameters:
+                self.group_table[name] = np.concatenate((self.group_table[name], values[name]))
+
+        stored['group_id'] = compact(np.full(count, group), self.agent_dtypes['group_id'])
+        return stored
+
+    def append_agents(self, fields, sampled=()):
+        for name, values in self.stored_fields(fields, sampled).items():
+            setattr(self, name, np.concatenate((getattr(self, name), values)))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Handle System Plotting, Saving, Styling
+    # ------------------------------------------------------------------------------------------------------------------
+    def snapshot(self):
+        types = [self.agent_types[type_id] for type_id in self.type_id]
+
+        return self.position.copy(), self.size.copy(), types, self.state.copy()
+
+    def contact_log_agents(self):
+        return list(self.agent_types), self.type_id, infectious_ids(self.state)
+
+    def trajectory_frame(self):
+        return list(self.agent_types), self.type_id, self.position, self.size, self.state, self.velocity
+
+    def state_counts(self):
+        return list(self.agent_types), count_states(self.type_id, self.state, len(self.agent_types))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Handle Checkpoints
+    # ------------------------------------------------------------------------------------------------------------------
+    def checkpoint_state(self):
+        header = {'agent_types': self.agent_types,
+                  'disease_profiles': [serialize_profile(profile) for profile in self.disease_profiles],
+                  'infection_profiles': [serialize_profile(profile) for profile in self.infection_profiles],
+                  'contact_random': self.contact_random.bit_generator.state,
+                  'agent_parameters': list(self.agent_parameters)}
+
+        arrays = {name: getattr(self, name) for name in self.agent_arrays}
+        arrays.update({'group_' + name: table for name, table in self.group_table.items()})
+
+        return header, arrays
+
+    def restore_state(self, header, arrays):
+        self.agent_types = header['agent_types']
+        self.disease_profiles = [deserialize_profile(profile) for profile in header['disease_profiles']]
+        self.infection_profiles = [deserialize_profile(profile) for profile in header['infection_profiles']]
+        self.check_interaction_cutoff()
+        if 'contact_random' in header:
+            self.contact_random.bit_generator.state = header['contact_random']
+
+        # Copied out of the memory map (by compact), so the checkpoint file can be replaced by the next checkpoint.
+        # Checkpoints without groups have an array for every group parameter.
+        if 'group_id' in arrays:
+            self.group_table = {name: compact(arrays['group_' + name], self.agent_dtypes[name]) for name in self.group_parameters}
+            self.agent_parameters = {name: compact(arrays[name], self.agent_dtypes[name]) for name in header['agent_parameters']}
+        else:
+            self.group_table = {name: np.zeros(1, dtype=self.agent_dtypes[name]) for name in self.group_parameters}
+            self.agent_parameters = {name: compact(arrays[name], self.agent_dtypes[name]) for name in self.group_parameters}
+            arrays = dict(arrays, group_id=np.zeros(len(arrays['state']), dtype=int))
+
+        for name in self.agent_columns:
+            setattr(self, name, compact(arrays[name], self.agent_dtypes[name]))
+
+        if self.cell_list is not None:
+            self.cell_list.reference_position = None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Handle System Simulation
+    # ------------------------------------------------------------------------------------------------------------------
+    def apply_boundary_conditions(self):
+        self.position = (self.position % self.box).astype(self.precision, copy=False)
+
+    def sample(self, parameter, count, random=None):
+        # Values of an agent parameter for count new agents. Distribution specs are drawn in one go from the system
+        # generator (or random), other callables are called once per agent like in Agent.
+        if isinstance(parameter, Distribution):
+            return parameter.sample(count, random or self.random)
+        if callable(parameter):
+            return np.array([parameter() for _ in range(count)])
+
+        return np.full(count, parameter)
+
+    def add_agent(self, parameters):
+        self.add_agents(parameters, 1)
+
+    def add_agents(self, parameters, count):
+        # Sample count agents from the same parameters, place them without overlap and store them as new rows of the
+        # agent arrays
+        parameters = resolve_parameters(parameters)
+        self.append_agents(self.new_agents(parameters, count, self.random, self.position, self.size), self.sampled_parameters(parameters))
+
+    def new_agents(self, parameters, count, random, position, size):
+        # Agent arrays of count new agents, drawn from random and placed without overlap with the agents at position
+        disease_profile_id = self.lookup_index(self.disease_profiles, parameters['disease_profile'])
+        infection_profile_id = self.lookup_index(self.infection_profiles, parameters['infection_profile'])
+        self.check_interaction_cutoff()
+
+        state = self.sample(parameters['status'], count, random)
+        will_recover = random.uniform(0, 1, count) < parameters['recoverProbability']
+        new_size = self.sample(parameters['size'], count, random)
+        healthy_velocity = self.sample(parameters['healthy_velocity'], count, random)
+        incubation_velocity = self.sample(parameters['incubation_velocity'], count, random)
+        sickness_velocity = self.sample(parameters['sickness_velocity'], count, random)
+        time_to_incubate = self.sample(parameters['timeToIncubate'], count, random)
+        time_to_recover = self.sample(parameters['timeToRecover'], count, random)
+        time_to_die = self.sample(parameters['timeToDie'], count, random)
+
+        new_position = place_agents(self.box, new_size, position, size, random=random.random)
+
+        direction = 2*(random.random((count, 2)) - 0.5)
+        direction = direction / np.linalg.norm(direction, axis=1)[:, None]
+        velocity = direction * state_speed(state, healthy_velocity, incubation_velocity, sickness_velocity)[:, None]
+
+        countdown = np.zeros(count, dtype=int)
+        countdown[state == INCUBATING] = time_to_incubate[state == INCUBATING]
+        countdown[state == SICK] = np.where(will_recover, time_to_recover, time_to_die)[state == SICK]
+
+        return dict(position=new_position,
+                    velocity=velocity,
+                    mass=self.sample(parameters['mass'], count, random),
+                    size=new_size,
+                    type_id=np.full(count, self.lookup_index(self.agent_types, parameters['type'])),
+                    state=state,
+                    countdown=countdown,
+                    will_recover=will_recover,
+                    immobile=self.sample(parameters['immobile'], count, random),
+                    transparent=self.sample(parameters['transparent'], count, random),
+                    healthy_velocity=healthy_velocity,
+                    incubation_velocity=incubation_velocity,
+                    sickness_velocity=sickness_velocity,
+                    time_to_incubate=time_to_incubate,
+                    time_to_recover=time_to_recover,
+                    time_to_die=time_to_die,
+                    disease_profile_id=np.full(count, disease_profile_id),
+                    infection_profile_id=np.full(count, infection_profile_id))
+
+    def check_interaction_cutoff(self):
+        # Pairs further apart than the cutoff are never evaluated, so infections up to the range of the profiles would be
+        # dropped without notice. An infection needs both profiles to be nonzero, so the largest distance of an
+        # infection is the smaller of the largest disease and the largest infection profile range, when known.
+        if self.interaction_cutoff is None:
+            return
+
+        reach = None
+        for profiles in (self.disease_profiles, self.infection_profiles):
+            ranges = [profile_range(profile) for profile in profiles]
+            if len(ranges) > 0 and None not in ranges:
+                reach = max(ranges) if reach is None else min(reach, max(ranges))
+
+        if reach is not None and self.interaction_cutoff < reach:
+            raise ValueError('interaction_cutoff ' + str(self.interaction_cutoff) + ' is shorter than the range ' + str(reach) +
+                             ' of the disease and infection profiles, infections beyond the cutoff would be dropped')
+
+    def neighbor_pairs(self):
+        # All ordered pairs (i, j), i != j, that interact, together with the minimum image displacement from j to i
+        # and its length. Without an interaction cutoff every pair interacts, otherwise the cell list only returns
+        # pairs closer than the cutoff. The pairs are kept until the position array is replaced, i.e. the agents move.
+        if self.pair_cache is not None and self.pair_cache[0] is self.position:
+            return self.pair_cache[1]
+
+        if self.active_sets:
+            pairs = self.active_pairs()
+        elif self.cell_list is not None:
+            pairs = self.cell_list.pairs(self.position)
+        else:
+            i, j = np.nonzero(~np.eye(self.number_of_agents, dtype=bool))
+            displacement = minimum_image(self.position[i] - self.position[j], self.box)
+            pairs = i, j, displacement, np.linalg.norm(displacement, axis=1)
+
+        self.pair_cache = (self.position, pairs)
+        return pairs
+
+    def active_pairs(self):
+        # Pairs among the agents that can still exert a force or take part in an infection: agents that are not
+        # transparent, or are susceptible, incubating or sick. Dead agents are neither, so they are left out of the
+        # neighbour search. Without a cutoff the pairs come in the same order as with all agents, with a cutoff the
+        # cell list is rebuilt whenever the active agents change.
+        active = np.nonzero(~self.transparent | (self.state == SUSCEPTIBLE) | (self.state == INCUBATING) | (self.state == SICK))[0]
+        position = self.position[active]
+
+        if self.cell_list is not None:
+            if self.active_agents is None or not np.array_equal(active, self.active_agents):
+                self.cell_list.reference_position = None
+            self.active_agents = active
+            i, j, displacement, r = self.cell_list.pairs(position)
+        else:
+            i, j = np.nonzero(~np.eye(len(active), dtype=bool))
+            displacement = minimum_image(position[i] - position[j], self.box)
+            r = np.linalg.norm(displacement, axis=1)
+
+        return active[i], active[j], displacement, r
+
+    @staticmethod
+    def select_pairs(pairs, selection):
+        return tuple(values[selection] for values in pairs)
+
+    def set_velocity_magnitude(self, indices, magnitude):
+        speed = np.linalg.norm(self.velocity[indices], axis=1)
+        moving = speed > 0
+        self.velocity[indices[moving]] = (magnitude[moving] / speed[moving])[:, None] * self.velocity[indices[moving]]
+        self.velocity[indices[~moving]] = 0
+
+    def update_speeds(self, indices):
+        # Set the speed of the given agents to the speed belonging to their (new) state
+        self.set_velocity_magnitude(indices, state_speed(self.state[indices], self.agent_values('healthy_velocity', indices), self.agent_values('incubation_velocity', indices), self.agent_values('sickness_velocity', indices)))
+
+    def handle_states(self):
+        # Progress the disease state of all incubating and sick agents
+        sick, recovered, died = progress_states(self.state, self.countdown, self.will_recover, self.time_to_recover, self.time_to_die)
+
+        self.immobile[died] = True
+        self.transparent[died] = True
+        self.update_speeds(np.concatenate((sick, recovered, died)))
+
+        return len(sick) + len(recovered) + len(died)
+
+    def infection_probability(self, i, j, r):
+        # Probability that agent i infects agent j at distance r, for arrays of pairs
+        probability = np.zeros(len(r))
+        disease_profile_id = self.agent_values('disease_profile_id', i)
+        for profile_id in np.unique(disease_profile_id):
+            selection = disease_profile_id == profile_id
+            probability[selection] = evaluate_profile(self.disease_profiles[profile_id], r[selection])
+        infection_profile_id = self.agent_values('infection_profile_id', j)
+        for profile_id in np.unique(infection_profile_id):
+            selection = infection_profile_id == profile_id
+            probability[selection] *= evaluate_profile(self.infection_profiles[profile_id], r[selection])
+
+        return probability
+
+    def draw_infections(self, targets, probability):
+        # Agents infected by the infection attempts (targets, probability)
+        return infection_draw(targets, probability, self.number_of_agents, self.random.random)
+
+    def handle_infections(self, pairs):
+        # Every infectious agent gets one infection attempt on every susceptible neighbour. Returns the number of
+        # infection attempts and infections.
+        infectious = (self.state == INCUBATING) | (self.state == SICK)
+        susceptible = self.state == SUSCEPTIBLE
+        if not infectious.any() or not susceptible.any():
+            return 0, 0
+
+        i, j, displacement, r = self.select_pairs(pairs, infectious[pairs[0]] & susceptible[pairs[1]])
+        probability = self.infection_probability(i, j, r)
+
+        infected = self.draw_infections(j, probability)
+        infect(self.state, self.countdown, self.time_to_incubate, infected)
+        self.update_speeds(infected)
+
+        if self.contact_log is not None:
+            exposed = probability > 0
+            self.contact_log.append(self.time, i[exposed], j[exposed], r[exposed], attribute_infections(j[exposed], probability[exposed], infected, self.contact_random))
+
+        return len(r), len(infected)
+
+    def solid_pairs(self, pairs):
+        # Pairs of agents that are not transparent and not at the same position, which exert forces on each other
+        solid = ~self.transparent
+        return self.select_pairs(pairs, solid[pairs[0]] & solid[pairs[1]] & (pairs[3] > 0))
+
+    def pair_forces(self, i, j, displacement, r):
+        # Total force on every agent of the pairs (i, j)
+        magnitude = self.pair_force(r) / r
+        force = np.zeros_like(self.position)
+        force[:, 0] = np.bincount(i, weights=magnitude*displacement[:, 0], minlength=len(force))
+        force[:, 1] = np.bincount(i, weights=magnitude*displacement[:, 1], minlength=len(force))
+
+        return force
+
+    def handle_forces(self, pairs):
+        # Pairwise forces between all neighbours that are not transparent
+        pairs = self.solid_pairs(pairs)
+        if self.active_sets:
+            # Immobile agents are not moved, so the forces on them are not needed
+            pairs = self.select_pairs(pairs, ~self.immobile[pairs[0]])
+
+        return self.pair_forces(*pairs)
+
+    def current_force(self, pairs):
+        # Forces at the current positions, computed once until the agents move or one of them becomes transparent
+        if self.force_cache is not None and self.force_cache[0] is self.position and np.array_equal(self.force_cache[1], self.transparent):
+            return self.force_cache[2]
+
+        force = self.handle_forces(pairs)
+        self.force_cache = (self.position, self.transparent.copy(), force)
+        return force
+
+    def step_profile_phases(self):
+        return [('handle_states', 'states', lambda transitions: {'transitions': transitions}),
+                ('neighbor_pairs', 'neighbor_search', None),
+                ('handle_infections', 'infections', lambda result, pairs: {'infection_attempts': result[0], 'infections': result[1]}),
+                ('pair_forces', 'forces', lambda force, i, j, displacement, r: {'pairs': len(i)}),
+                ('vectorized_energy_drift_compensation', 'speed_limit', None),
+                ('apply_boundary_conditions', 'boundary_conditions', None)]
+
+    def record_diagnostics(self, substeps, seconds):
+        pairs = self.neighbor_pairs()
+        i, j, displacement, r = self.solid_pairs(pairs)
+        force = self.current_force(pairs)
+
+        kinetic_energy = 0.5*np.sum(self.mass[:, None]*self.velocity**2)
+        potential_energy = 0.5*np.sum(self.potential_kernel.potential(r))
+        mobile = np.count_nonzero(~self.immobile)
+
+        values = {'time': self.time, 'substeps': substeps, 'seconds': seconds,
+                  'kinetic_energy': kinetic_energy, 'potential_energy': potential_energy,
+                  'total_energy': kinetic_energy + potential_energy,
+                  # Two degrees of freedom per agent, with the Boltzmann constant 1
+                  'temperature': kinetic_energy / max(mobile, 1),
+                  'max_force': np.linalg.norm(force, axis=1).max(initial=0),
+                  'min_distance': r.min(initial=np.inf)}
+        for key, value in values.items():
+            self.diagnostics[key].append(float(value))
+
+    def write(self):
+        super().write()
+
+        if self.diagnostics_file is not None and self.energy_diagnostics:
+            json.dump(self.diagnostics, codecs.open(self.diagnostics_file, 'w', encoding='utf-8'), separators=(',', ':'), indent=4)
+
+    def step(self):
+        start = time.perf_counter()
+        self.handle_states()
+
+        pairs = self.neighbor_pairs()
+        self.handle_infections(pairs)
+        substeps = INTEGRATORS[self.integrator](self, pairs)
+
+        if self.energy_diagnostics:
+            self.record_diagnostics(substeps, time.perf_counter() - start)